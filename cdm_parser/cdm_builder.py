@@ -1,7 +1,57 @@
 import os
+from contextlib import nullcontext
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from postgres_manager import PostgresManager
 from constants import *
+from utils import batches
+
+OBSERVATION_COLUMNS = ('observation_id', 'person_id', 'observation_concept_id', 'observation_datetime', 'observation_type_concept_id',
+    'value_as_string', 'value_as_concept_id', 'visit_occurrence_id', 'unit_concept_id', 'observation_source_value',
+    'observation_source_concept_id', 'obs_event_field_concept_id')
+
+MEASUREMENT_COLUMNS = ('measurement_id', 'person_id', 'measurement_concept_id', 'measurement_datetime', 'measurement_type_concept_id',
+    'value_as_number', 'value_as_concept_id', 'visit_occurrence_id', 'unit_concept_id', 'measurement_source_value',
+    'measurement_source_concept_id', 'value_source_value', 'operator_concept_id')
+
+CONDITION_COLUMNS = ('condition_occurrence_id', 'person_id', 'condition_concept_id', 'condition_start_datetime', 'condition_type_concept_id',
+    'condition_status_concept_id', 'visit_occurrence_id', 'condition_source_value', 'condition_source_concept_id',
+    'condition_status_source_value')
+
+PERSON_COLUMNS = ('person_id', 'gender_concept_id', 'year_of_birth', 'death_datetime', 'race_concept_id',
+    'ethnicity_concept_id', 'gender_source_concept_id', 'race_source_concept_id', 'ethnicity_source_concept_id',
+    'care_site_id')
+
+VISIT_OCCURRENCE_COLUMNS = ('visit_occurrence_id', 'person_id', 'visit_concept_id', 'visit_start_date',
+    'visit_start_datetime', 'visit_end_date', 'visit_end_datetime', 'visit_type_concept_id', 'care_site_id',
+    'visit_source_concept_id', 'admitted_from_concept_id', 'discharge_to_concept_id')
+
+ID_TABLE_COLUMNS = ('person_id', 'source_id', 'cohort_id')
+
+CDM_TABLES = {
+    CONDITION_OCCURRENCE: {
+        TABLE: 'CONDITION_OCCURRENCE',
+        COLUMNS: CONDITION_COLUMNS,
+        ID_COLUMN: 'condition_occurrence_id',
+        KEY_COLUMNS: ('person_id', 'visit_occurrence_id', 'condition_concept_id', 'condition_start_datetime'),
+        SEQUENCE: CONDITION_SEQUENCE,
+    },
+    MEASUREMENT: {
+        TABLE: 'MEASUREMENT',
+        COLUMNS: MEASUREMENT_COLUMNS,
+        ID_COLUMN: 'measurement_id',
+        KEY_COLUMNS: ('person_id', 'visit_occurrence_id', 'measurement_concept_id', 'measurement_datetime',
+            'value_as_number', 'value_as_concept_id'),
+        SEQUENCE: MEASUREMENT_SEQUENCE,
+    },
+    OBSERVATION: {
+        TABLE: 'OBSERVATION',
+        COLUMNS: OBSERVATION_COLUMNS,
+        ID_COLUMN: 'observation_id',
+        KEY_COLUMNS: ('person_id', 'visit_occurrence_id', 'observation_concept_id', 'observation_datetime',
+            'value_as_string', 'value_as_concept_id'),
+        SEQUENCE: OBSERVATION_SEQUENCE,
+    },
+}
 
 def create_database():
     """ Create the CDM database.
@@ -23,13 +73,16 @@ def set_schema(pg):
     print('Setting up the CDM schema')
     pg.execute_file(OMOP_CDM_DDL_PATH)
 
-def insert_vocabulary(pg):
-    """ Insert the vocabulary.
+def insert_vocabulary(pg, commit_every=None):
+    """ Insert the vocabulary. If commit_every is provided, the files are
+        inserted in transactions with that number of files.
     """
     print('Insert the vocabulary')
-    for table, vocabulary_file in VOCABULARY_FILES.items():
-        print(f'Populating the {table} table')
-        pg.copy_from_file(table, f'{os.environ[VOCABULARY_PATH]}/{vocabulary_file}')
+    for batch in batches(VOCABULARY_FILES.items(), commit_every):
+        with pg.transaction() if commit_every else nullcontext():
+            for table, vocabulary_file in batch:
+                print(f'Populating the {table} table')
+                pg.copy_from_file(table, f'{os.environ[VOCABULARY_PATH]}/{vocabulary_file}')
 
 def truncate_vocabulary(pg):
     """ Truncate the vocabulary tables.
@@ -70,134 +123,194 @@ def create_id_table(pg):
     pg.run_sql(f'CREATE TABLE IF NOT EXISTS {ID_TABLE} \
         (person_id bigint PRIMARY KEY, source_id varchar(100), cohort_id varchar(100) NOT NULL)')
 
-def get_person_id(source_id, cohort_id, pg):
-    """ Retrieve the person id from the source id.
+def create_checkpoint_table(pg):
+    """ Create the table to store the progress when parsing a dataset.
+    """
+    pg.run_sql(f"""CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (cohort_id varchar(100) NOT NULL,
+        dataset varchar(100) NOT NULL, range_start bigint NOT NULL, last_row bigint NOT NULL, allocator text,
+        updated_datetime timestamp DEFAULT now(), PRIMARY KEY (cohort_id, dataset, range_start))""")
+
+def get_checkpoint(pg, cohort_id, dataset, range_start):
+    """ Retrieve the last row committed and the state of the id allocator
+        when parsing a range of the dataset.
     """
     return pg.run_sql(
-        f"SELECT person_id FROM {ID_TABLE} WHERE source_id='{source_id}' AND cohort_id='{cohort_id}' LIMIT 1",
-        fetch_one=True,
+        f"""SELECT last_row, allocator FROM {CHECKPOINT_TABLE} WHERE cohort_id=%s AND dataset=%s
+        AND range_start=%s""",
+        parameters=(str(cohort_id), dataset, range_start),
+        fetch_all=True,
     )
 
-def insert_id_record(source_id, person_id, cohort_id, pg):
-    """ Insert a new record in the temporary table.
+def save_checkpoint(pg, cohort_id, dataset, range_start, last_row, allocator):
+    """ Store the last row committed and the state of the id allocator when
+        parsing a range of the dataset.
     """
-    return pg.run_sql(f"INSERT INTO {ID_TABLE} VALUES ({person_id}, '{source_id}', '{cohort_id}')")
+    pg.run_sql(
+        f"""INSERT INTO {CHECKPOINT_TABLE} (cohort_id, dataset, range_start, last_row, allocator)
+        VALUES (%s,%s,%s,%s,%s) ON CONFLICT (cohort_id, dataset, range_start) DO UPDATE SET
+        last_row = EXCLUDED.last_row, allocator = EXCLUDED.allocator, updated_datetime = now()""",
+        parameters=(str(cohort_id), dataset, range_start, last_row, allocator),
+    )
 
-def build_person(gender, year_of_birth, cohort_id, death_datetime):
-    """ Build the sql statement for a person.
+def create_row_hash_table(pg):
+    """ Create the table to store the hash of the values in each wave of the source rows
+        and the visits created from them.
     """
-    return (("""INSERT INTO PERSON (person_id,gender_concept_id,year_of_birth,death_datetime,
-        race_concept_id,ethnicity_concept_id,gender_source_concept_id,race_source_concept_id,
-        ethnicity_source_concept_id,care_site_id) VALUES (nextval('person_sequence'),%s,%s,%s,0,0,0,0,0,%s)
-        RETURNING person_id;
-    """), (gender, year_of_birth, death_datetime, cohort_id))
+    pg.run_sql(f"""CREATE TABLE IF NOT EXISTS {ROW_HASH_TABLE} (cohort_id varchar(100) NOT NULL,
+        source_id varchar(100) NOT NULL, prefix varchar(100) NOT NULL, suffix varchar(100) NOT NULL,
+        hash varchar(40) NOT NULL, visit_ids bigint[], PRIMARY KEY (cohort_id, source_id, prefix, suffix))""")
 
-def update_person(person_id, death_datetime):
-    """ Build the sql statement to update a person.
+def get_row_hashes(cohort_id, pg):
+    """ Retrieve the source id, wave (prefix and suffix), hash, and visit ids for
+        every source row in the cohort.
     """
-    return (("""UPDATE PERSON SET death_datetime = %s WHERE person_id = %s;"""),
-        (death_datetime, person_id))
+    return pg.run_sql(
+        f"SELECT source_id, prefix, suffix, hash, visit_ids FROM {ROW_HASH_TABLE} WHERE cohort_id=%s",
+        parameters=(str(cohort_id),),
+        fetch_all=True,
+    )
 
-def build_observation(person_id, field, value=None, value_as_concept=None, source_value=None,
-    date='19700101 00:00:00', visit_id=None, additional_info=None, symbol_cid=None):
-    """ Build the sql statement for an observation.
+def save_row_hashes(row_hashes, pg):
+    """ Insert or update the records (cohort id, source id, prefix, suffix, hash, visit ids).
     """
-    unit_concept_id = field[UNIT_CONCEPT_ID] if field[UNIT_CONCEPT_ID] else None
-    return (("""INSERT INTO OBSERVATION (observation_id,person_id,observation_concept_id,observation_datetime,
-        observation_type_concept_id,value_as_string,value_as_concept_id,visit_occurrence_id,unit_concept_id,
-        observation_source_value,observation_source_concept_id,obs_event_field_concept_id) VALUES 
-        (nextval('observation_sequence'),%s,%s,%s, 32879, %s,%s,%s,%s,%s, 0, 0);
-    """), (person_id, field[CONCEPT_ID], date, value, value_as_concept, visit_id, unit_concept_id, source_value))
+    pg.execute_values(
+        f"""INSERT INTO {ROW_HASH_TABLE} (cohort_id, source_id, prefix, suffix, hash, visit_ids) VALUES %s
+        ON CONFLICT (cohort_id, source_id, prefix, suffix) DO UPDATE SET hash = EXCLUDED.hash,
+        visit_ids = EXCLUDED.visit_ids""",
+        row_hashes,
+        template='(%s, %s, %s, %s, %s, %s::bigint[])',
+    )
 
-def build_observation_bulk(observations):
-    """ Build the sql statement for a bulk insert of observations.
+def delete_records(person_ids, visit_ids, pg):
+    """ Delete the observations, measurements, and conditions for the persons
+        in the visits provided.
     """
-    return f"""INSERT INTO OBSERVATION (observation_id,person_id,observation_concept_id,observation_datetime,
-        observation_type_concept_id,value_as_string,value_as_concept_id,visit_occurrence_id,unit_concept_id,
-        observation_source_value,observation_source_concept_id,obs_event_field_concept_id) VALUES 
-        {", ".join(observations)};"""
+    for domain in CDM_TABLES.values():
+        pg.run_sql(
+            f"DELETE FROM {domain[TABLE]} WHERE person_id = ANY(%s) AND visit_occurrence_id = ANY(%s)",
+            parameters=(list(person_ids), list(visit_ids)),
+        )
 
-def build_observation_values(person_id, field, value=None, value_as_concept=None, source_value=None,
-    date='19700101 00:00:00', visit_id=None, additional_info=None, symbol_cid=None):
-    """ Build the sql statement for an observation.
+def delete_visits(visit_ids, pg):
+    """ Delete the visits provided.
     """
-    unit_concept_id = field[UNIT_CONCEPT_ID] if field[UNIT_CONCEPT_ID] else None
-    return ("(nextval('observation_sequence'),{},{},'{}', 32879, '{}',{},{},{},'{}', 0, 0)".format(
-        person_id, field[CONCEPT_ID], date, value, value_as_concept, visit_id, unit_concept_id, source_value)
-    ).replace("None", "NULL")
+    pg.run_sql("DELETE FROM VISIT_OCCURRENCE WHERE visit_occurrence_id = ANY(%s)", parameters=(list(visit_ids),))
 
-def build_measurement(person_id, field, value=None, value_as_concept=None, source_value=None,
-    date='19700101 00:00:00', visit_id=None, additional_info=None, symbol_cid=None):
-    """ Build the sql statement for a measurement.
+def reserve_ids(pg, sequence, size):
+    """ Reserve a block of ids from a sequence, returns the last id in the block.
+        The advisory lock prevents other processes from retrieving a value from
+        the sequence between the nextval and setval.
     """
-    unit_concept_id = field[UNIT_CONCEPT_ID] if field[UNIT_CONCEPT_ID] else None
-    return ("""INSERT INTO MEASUREMENT (measurement_id,person_id,measurement_concept_id,measurement_datetime,
-        measurement_type_concept_id,value_as_number,value_as_concept_id,visit_occurrence_id,unit_concept_id,
-        measurement_source_value,measurement_source_concept_id,value_source_value,operator_concept_id)
-        VALUES (nextval('measurement_sequence'),%s,%s,%s,0,%s,%s,%s,%s,%s,0,%s,%s)
-    """, (person_id, field[CONCEPT_ID], date, value, value_as_concept, visit_id, unit_concept_id, additional_info, source_value, symbol_cid))
+    pg.run_sql(f"SELECT pg_advisory_lock(hashtext('{sequence}'));")
+    try:
+        return pg.run_sql(f"SELECT setval('{sequence}', nextval('{sequence}') + {size - 1});", fetch_one=True)
+    finally:
+        pg.run_sql(f"SELECT pg_advisory_unlock(hashtext('{sequence}'));")
 
-def build_measurement_bulk(measurements):
-    """ Build the sql statement for a bulk insert of measurements.
+def get_person_ids(cohort_id, pg):
+    """ Retrieve the source id, person id, and death datetime for every person in the cohort.
     """
-    return f"""INSERT INTO MEASUREMENT (measurement_id,person_id,measurement_concept_id,measurement_datetime,
-        measurement_type_concept_id,value_as_number,value_as_concept_id,visit_occurrence_id,unit_concept_id,
-        measurement_source_value,measurement_source_concept_id,value_source_value,operator_concept_id)
-        VALUES {", ".join(measurements)};"""
+    return pg.run_sql(
+        f"""SELECT ids.source_id, ids.person_id, person.death_datetime FROM {ID_TABLE} ids
+        LEFT JOIN PERSON person ON person.person_id = ids.person_id WHERE ids.cohort_id=%s
+        ORDER BY ids.person_id""",
+        parameters=(str(cohort_id),),
+        fetch_all=True,
+    )
 
-def build_measurement_values(person_id, field, value=None, value_as_concept=None, source_value=None,
-    date='19700101 00:00:00', visit_id=None, additional_info=None, symbol_cid=None):
-    """ Build the sql statement for a measurement.
+def insert_id_records(id_records, pg):
+    """ Insert the new records (person id, source id, cohort id) in the temporary table.
     """
-    unit_concept_id = field[UNIT_CONCEPT_ID] if field[UNIT_CONCEPT_ID] else None
-    return ("(nextval('measurement_sequence'),{},{},'{}',0,{},{},{},{},'{}',0,'{}',{})".format(
-        person_id, field[CONCEPT_ID], date, value, value_as_concept, visit_id, unit_concept_id, additional_info, source_value, symbol_cid)
-    ).replace("None", "NULL")
+    pg.execute_values(f"INSERT INTO {ID_TABLE} (person_id, source_id, cohort_id) VALUES %s", id_records)
 
-def build_condition(person_id, field, value=None, value_as_concept=None, source_value=None,
-    date='19700101 00:00:00', visit_id=None, additional_info=None, symbol_cid=None):
-    """ Build the sql statement for a condition.
+def build_persons():
+    """ Build the sql statement and the template for a bulk insert of persons
+        (person id, gender, year of birth, death datetime, cohort id).
     """
-    return (("""INSERT INTO CONDITION_OCCURRENCE (condition_occurrence_id,person_id,condition_concept_id,
-        condition_start_datetime,condition_type_concept_id,condition_status_concept_id,visit_occurrence_id,
-        condition_source_value,condition_source_concept_id,condition_status_source_value) VALUES
-        (nextval('condition_sequence'),%s,%s,%s,0,0,%s,%s,0,%s)
-    """), (person_id, field[CONCEPT_ID], date, visit_id, source_value, additional_info))
+    return ("""INSERT INTO PERSON (person_id,gender_concept_id,year_of_birth,death_datetime,
+        race_concept_id,ethnicity_concept_id,gender_source_concept_id,race_source_concept_id,
+        ethnicity_source_concept_id,care_site_id) VALUES %s
+    """, ("(%(person_id)s, %(gender)s, %(year_of_birth)s, %(death_datetime)s, 0, 0, 0, 0, 0, "
+        "%(cohort_id)s)"))
 
-def build_condition_bulk(conditions):
-    """ Build the sql statement for a bulk insert of conditions.
+def insert_persons(persons, pg):
+    """ Insert multiple persons.
     """
-    return f"""INSERT INTO CONDITION_OCCURRENCE (condition_occurrence_id,person_id,condition_concept_id,
-        condition_start_datetime,condition_type_concept_id,condition_status_concept_id,visit_occurrence_id,
-        condition_source_value,condition_source_concept_id,condition_status_source_value) VALUES
-        {", ".join(conditions)};"""
+    (statement, template) = build_persons()
+    pg.execute_values(statement, persons, template=template)
 
-def build_condition_values(person_id, field, value=None, value_as_concept=None, source_value=None,
-    date='19700101 00:00:00', visit_id=None, additional_info=None, symbol_cid=None):
-    """ Build the sql statement for a condition.
+def build_person_record(person):
+    """ Build the record (following PERSON_COLUMNS) for a person (person id,
+        gender, year of birth, death datetime, cohort id).
+    """
+    return (person['person_id'], person['gender'], person['year_of_birth'], person['death_datetime'], 0, 0, 0, 0, 0,
+        person['cohort_id'])
+
+def build_person_updates():
+    """ Build the sql statement for a bulk update of persons (person id, death datetime).
+    """
+    return """UPDATE PERSON SET death_datetime = updates.death_datetime::timestamp
+        FROM (VALUES %s) AS updates (person_id, death_datetime) WHERE PERSON.person_id = updates.person_id
     """
-    return ("(nextval('condition_sequence'),{},{},'{}',0,0,{},'{}',0,'{}')".format(
-        person_id, field[CONCEPT_ID], date, visit_id, source_value, additional_info)
-    ).replace("None", "NULL")
 
-def check_duplicated_observation(person_id, field, value=None, value_as_concept=None, source_value=None,
+def update_persons(updates, pg):
+    """ Update the death datetime for multiple persons.
+    """
+    pg.execute_values(build_person_updates(), updates)
+
+def build_insert(domain):
+    """ Build the sql statement to prepare for the inserts in the table for a
+        domain (the parameters follow the columns for the domain).
+    """
+    columns = CDM_TABLES[domain][COLUMNS]
+    return f"""INSERT INTO {CDM_TABLES[domain][TABLE]} ({','.join(columns)})
+        VALUES ({','.join(f'${i}' for i in range(1, len(columns) + 1))})"""
+
+def build_insert_bulk(domain):
+    """ Build the sql statement for a bulk insert in the table for a domain.
+    """
+    return f"INSERT INTO {CDM_TABLES[domain][TABLE]} ({','.join(CDM_TABLES[domain][COLUMNS])}) VALUES %s"
+
+def insert_records(records, pg, page_size=100):
+    """ Insert multiple records (domain and record following the columns for
+        the domain) using a prepared statement for each domain, committed together.
+    """
+    statements = []
+    for domain in CDM_TABLES.keys():
+        domain_records = [record for (record_domain, record) in records if record_domain == domain]
+        if domain_records:
+            name = f'insert_{CDM_TABLES[domain][TABLE].lower()}'
+            pg.prepare(name, build_insert(domain))
+            statements.append((name, domain_records))
+    pg.execute_prepared_many(statements, page_size=page_size)
+
+def insert_records_bulk(domain, records, pg, page_size=1000):
+    """ Insert multiple records (following the columns for the domain) in bulk.
+    """
+    if records:
+        pg.execute_values(build_insert_bulk(domain), records, page_size=page_size)
+
+def build_observation_record(observation_id, person_id, field, value=None, value_as_concept=None, source_value=None,
     date='19700101 00:00:00', visit_id=None, additional_info=None, symbol_cid=None):
-    return ((f"""SELECT COUNT(observation_id) FROM OBSERVATION WHERE person_id=%s AND observation_concept_id=%s
-        AND observation_datetime=%s AND {"value_as_string=%s" if value else "value_as_concept_id=%s"} AND visit_occurrence_id=%s 
-    """), (person_id, field[CONCEPT_ID], date, str(value) if value else value_as_concept, visit_id))
+    """ Build the record (following OBSERVATION_COLUMNS) for an observation.
+    """
+    unit_concept_id = field[UNIT_CONCEPT_ID] if field[UNIT_CONCEPT_ID] else None
+    return (observation_id, person_id, field[CONCEPT_ID], date, 32879, value, value_as_concept, visit_id, unit_concept_id,
+        source_value, 0, 0)
 
-def check_duplicated_measurement(person_id, field, value=None, value_as_concept=None, source_value=None,
+def build_measurement_record(measurement_id, person_id, field, value=None, value_as_concept=None, source_value=None,
     date='19700101 00:00:00', visit_id=None, additional_info=None, symbol_cid=None):
-    return ((f"""SELECT COUNT(measurement_id) FROM MEASUREMENT WHERE person_id=%s AND
-        measurement_concept_id=%s AND measurement_datetime=%s AND {"value_as_number=%s" if value
-        else "value_as_concept_id=%s"} AND visit_occurrence_id=%s
-    """), (person_id, field[CONCEPT_ID], date, value or value_as_concept, visit_id))
+    """ Build the record (following MEASUREMENT_COLUMNS) for a measurement.
+    """
+    unit_concept_id = field[UNIT_CONCEPT_ID] if field[UNIT_CONCEPT_ID] else None
+    return (measurement_id, person_id, field[CONCEPT_ID], date, 0, value, value_as_concept, visit_id, unit_concept_id,
+        additional_info, 0, source_value, symbol_cid)
 
-def check_duplicated_condition(person_id, field, value=None, value_as_concept=None, source_value=None,
+def build_condition_record(condition_occurrence_id, person_id, field, value=None, value_as_concept=None, source_value=None,
     date='19700101 00:00:00', visit_id=None, additional_info=None, symbol_cid=None):
-    return (("""SELECT COUNT(condition_occurrence_id) FROM CONDITION_OCCURRENCE WHERE person_id=%s AND 
-        condition_concept_id=%s AND condition_start_datetime=%s AND visit_occurrence_id=%s
-    """), (person_id, field[CONCEPT_ID], date, visit_id))
+    """ Build the record (following CONDITION_COLUMNS) for a condition.
+    """
+    return (condition_occurrence_id, person_id, field[CONCEPT_ID], date, 0, 0, visit_id, source_value, 0, additional_info)
 
 def build_cohort(cohort_name, location_id):
     """ Build the sql statement for a care site.
@@ -212,15 +325,22 @@ def build_cohort(cohort_name, location_id):
         SELECT care_site_id FROM CARE_SITE WHERE care_site_name='{0}' LIMIT 1
     """.format(cohort_name, location_id)
 
-def build_visit_occurrence(person_id, start_date, end_date, cohort_id):
-    """ Build the sql statement for a visit occurence.
+def build_visit_occurrences():
+    """ Build the sql statement and the template for a bulk insert of visit
+        occurrences (visit id, person id, start date, end date, cohort id).
     """
-    return """INSERT INTO VISIT_OCCURRENCE (visit_occurrence_id,person_id,visit_concept_id,visit_start_date,
+    return ("""INSERT INTO VISIT_OCCURRENCE (visit_occurrence_id,person_id,visit_concept_id,visit_start_date,
         visit_start_datetime,visit_end_date,visit_end_datetime,visit_type_concept_id,care_site_id,visit_source_concept_id,
-        admitted_from_concept_id,discharge_to_concept_id) VALUES
-        (nextval('visit_occurrence_sequence'), {0}, 0, '{1}', '{1}', '{2}', '{2}', 0, {3}, 0, 0, 0)
-        RETURNING visit_occurrence_id
-    """.format(person_id, start_date, end_date, cohort_id)
+        admitted_from_concept_id,discharge_to_concept_id) VALUES %s
+    """, ("(%(visit_id)s, %(person_id)s, 0, %(start_date)s, %(start_date)s, %(end_date)s, %(end_date)s, 0, "
+        "%(cohort_id)s, 0, 0, 0)"))
+
+def build_visit_occurrence_record(visit):
+    """ Build the record (following VISIT_OCCURRENCE_COLUMNS) for a visit
+        occurrence (visit id, person id, start date, end date, cohort id).
+    """
+    return (visit['visit_id'], visit['person_id'], 0, visit['start_date'], visit['start_date'], visit['end_date'],
+        visit['end_date'], 0, visit['cohort_id'], 0, 0, 0)
 
 def build_location(address):
     """ Build the sql statement to insert a location.
@@ -233,10 +353,11 @@ def insert_cohort(cohort_name, location_id, pg):
     """
     return pg.run_sql(build_cohort(cohort_name, location_id), fetch_one=True)
 
-def insert_visit_occurrence(person_id, start_date, end_date, cohort_id, pg):
-    """ Insert the visit occurence information.
+def insert_visit_occurrences(visits, pg):
+    """ Insert multiple visit occurrences.
     """
-    return pg.run_sql(build_visit_occurrence(person_id, start_date, end_date, cohort_id), fetch_one=True)
+    (statement, template) = build_visit_occurrences()
+    pg.execute_values(statement, visits, template=template)
 
 def insert_location(address, pg):
     """ Insert a location.
@@ -263,38 +384,66 @@ def count_entries(pg):
         count.append(pg.run_sql(f'SELECT count({value}) FROM {key};', fetch_one=True))
     return count
 
-def get_visit_by_person_and_date(pg, person_id, start_date):
-    """ Retrieve the visit id for a person in a specific date.
+def get_record_keys(pg, domain, cohort_id):
+    """ Retrieve the columns identifying a record (see KEY_COLUMNS) for the records
+        of a domain in a cohort.
+    """
+    return pg.run_sql(f"""SELECT {','.join(CDM_TABLES[domain][KEY_COLUMNS])} FROM {CDM_TABLES[domain][TABLE]}
+        WHERE person_id IN (SELECT person_id FROM PERSON WHERE care_site_id = %s)""",
+        parameters=(cohort_id,), fetch_all=True)
+
+def get_visits_by_cohort(pg, cohort_id):
+    """ Retrieve the person id, start date, and visit id for the visits in a cohort
+        (including the visits without a cohort when the cohort id is None).
     """
-    return pg.run_sql(f"""SELECT visit_occurrence_id FROM VISIT_OCCURRENCE WHERE 
-        person_id = {person_id} AND visit_start_datetime = '{start_date}'""", fetch_one=True)
+    return pg.run_sql("""SELECT person_id, visit_start_datetime, visit_occurrence_id FROM VISIT_OCCURRENCE
+        WHERE care_site_id IS NOT DISTINCT FROM %s""", parameters=(cohort_id,), fetch_all=True)
 
-def get_visit_occurrences(pg, cohort_id):
-    """ Get all visit occurences.
+def get_visit_occurrences(pg, cohort_id, itersize=STREAM_DEFAULT_ITERSIZE):
+    """ Get all visit occurences, streamed from a server-side cursor (the
+        connection can't be used to commit until all the visits are read).
     """
     #keys = ['visit_id', 'person_id', 'year_of_birth', 'gender_concept_id', 'death_datetime']
-    return pg.run_sql(f"""SELECT v.visit_occurrence_id, v.visit_start_datetime, p.person_id, p.year_of_birth,
+    return pg.stream(f"""SELECT v.visit_occurrence_id, v.visit_start_datetime, p.person_id, p.year_of_birth,
         p.gender_concept_id, p.death_datetime FROM VISIT_OCCURRENCE AS v JOIN PERSON AS p ON 
         p.person_id = v.person_id {"WHERE p.care_site_id = " + str(cohort_id) if cohort_id is not None else ""}
-    """, fetch_all=True)
+    """, itersize=itersize, name='visit_occurrences')
+
+def count_visit_occurrences(pg, cohort_id):
+    """ Count the visit occurrences (for the persons in a cohort, if provided).
+    """
+    return pg.run_sql(f"""SELECT count(*) FROM VISIT_OCCURRENCE AS v JOIN PERSON AS p ON
+        p.person_id = v.person_id {"WHERE p.care_site_id = " + str(cohort_id) if cohort_id is not None else ""}
+    """, fetch_one=True)
+
+def group_by_visit(rows):
+    """ Group the rows (with the visit id as the first column) by visit.
+    """
+    visits = {}
+    for row in rows:
+        visits.setdefault(row[0], []).append(row[1:])
+    return visits
 
-def get_observations_by_visit_id(pg, visit_id):
-    """ Get observation by visit id and person id.
+def get_observations_by_visit_ids(pg, visit_ids):
+    """ Get the observations for multiple visits, grouped by visit id.
     """
-    return pg.run_sql(f"""SELECT observation_concept_id, observation_datetime, value_as_string, value_as_concept_id 
-        FROM OBSERVATION WHERE visit_occurrence_id = {visit_id};""", fetch_all=True)
+    return group_by_visit(pg.run_sql("""SELECT visit_occurrence_id, observation_concept_id, observation_datetime,
+        value_as_string, value_as_concept_id FROM OBSERVATION WHERE visit_occurrence_id = ANY(%s)
+        ORDER BY visit_occurrence_id, observation_id""", parameters=(list(visit_ids),), fetch_all=True))
 
-def get_measurements_by_visit_id(pg, visit_id):
-    """ Get observation by visit id and person id.
+def get_measurements_by_visit_ids(pg, visit_ids):
+    """ Get the measurements for multiple visits, grouped by visit id.
     """
-    return pg.run_sql(f"""SELECT measurement_concept_id, measurement_datetime, value_as_number, operator_concept_id 
-        FROM MEASUREMENT WHERE visit_occurrence_id = {visit_id};""", fetch_all=True)
+    return group_by_visit(pg.run_sql("""SELECT visit_occurrence_id, measurement_concept_id, measurement_datetime,
+        value_as_number, operator_concept_id FROM MEASUREMENT WHERE visit_occurrence_id = ANY(%s)
+        ORDER BY visit_occurrence_id, measurement_id""", parameters=(list(visit_ids),), fetch_all=True))
 
-def get_conditions_by_visit_id(pg, visit_id):
-    """ Get observation by visit id and person id.
+def get_conditions_by_visit_ids(pg, visit_ids):
+    """ Get the conditions for multiple visits, grouped by visit id.
     """
-    return pg.run_sql(f"""SELECT condition_concept_id, condition_start_datetime 
-        FROM CONDITION_OCCURRENCE WHERE visit_occurrence_id = {visit_id};""", fetch_all=True)
+    return group_by_visit(pg.run_sql("""SELECT visit_occurrence_id, condition_concept_id, condition_start_datetime
+        FROM CONDITION_OCCURRENCE WHERE visit_occurrence_id = ANY(%s)
+        ORDER BY visit_occurrence_id, condition_occurrence_id""", parameters=(list(visit_ids),), fetch_all=True))
 
 def insert_values(pg, table_name, columns):
     """ Insert values into a table according to the specification from the parameters.
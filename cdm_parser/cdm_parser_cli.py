@@ -1,14 +1,18 @@
 import click
 import os
+from contextlib import nullcontext
 from datetime import datetime
 
-from utils import export_config, import_config, run_command, parse_output
+from utils import batches, export_config, import_config, run_command, parse_output
 from constants import *
 from cdm_builder import *
 from parser import parse_csv_mapping
 from parse_dataset import DataParser
-from postgres_manager import PostgresManager
+from postgres_manager import PostgresManager, PostgresPool
 from parse_mapping import parse_mapping_to_columns, parse_visit
+from parallel_parser import parse_dataset_parallel
+from pipeline import PipelinedWriter
+from staging import StagingWriter, load_staging
 
 @click.group()
 def cli():
@@ -32,9 +36,11 @@ def cli():
 @click.option('--ignore-duplicates', prompt=False, default=False)
 @click.option('--bulk', prompt=False, default=False)
 @click.option('--bulk-range', prompt=False, default=1)
+@click.option('--db-settings', prompt=False, default='',
+    help='Session settings for each connection, e.g. "synchronous_commit=off;work_mem=64MB"')
 def set_up(user, password, host, port, database_name, vocabulary_path, destination_mapping,
     source_mapping, dataset, dataset_delimiter, follow_up_suffix, encoding, missing_values,
-    ignore_duplicates, bulk, bulk_range):
+    ignore_duplicates, bulk, bulk_range, db_settings):
     """ Set up the configurations needed.
     """
     configurations = {
@@ -53,7 +59,8 @@ def set_up(user, password, host, port, database_name, vocabulary_path, destinati
         MISSING_VALUES: missing_values,
         IGNORE_DUPLICATES: ignore_duplicates,
         BULK: bulk,
-        BULK_RANGE: bulk_range
+        BULK_RANGE: bulk_range,
+        DB_SETTINGS: db_settings,
     }
     export_config(DB_CONFIGURATION_PATH, DB_CONFIGURATION_SECTION, configurations)
 
@@ -100,15 +107,21 @@ def set_db(insert_voc, sequence_start, create_db):
     type=bool,
     help='Truncate the vocabulary tables'
 )
+@click.option(
+    '--commit-every',
+    default=None,
+    type=int,
+    help='Number of vocabulary files inserted in each transaction'
+)
 @cli.command()
-def insert_voc(truncate):
+def insert_voc(truncate, commit_every):
     """ Insert the vocabularies.
     """
     with PostgresManager() as pg:
         if truncate:
             truncate_vocabulary(pg)
         if VOCABULARY_PATH in os.environ:
-            insert_vocabulary(pg)
+            insert_vocabulary(pg, commit_every=commit_every)
 
 @cli.command()
 def drop_db():
@@ -135,7 +148,78 @@ def insert_constraints():
     help='Convert the caregories? Only valid for spss files'
 )
 @click.option('--drop-temp-tables/--no-drop-temp-tables', default=False, type=bool)
-def parse_data(cohort_name, cohort_location, start, limit, convert_categoricals, drop_temp_tables):
+@click.option(
+    '--copy/--no-copy',
+    default=False,
+    type=bool,
+    help='Load the observations, measurements, and conditions using COPY instead of INSERT statements'
+)
+@click.option(
+    '--copy-buffer-size',
+    default=COPY_BUFFER_DEFAULT_SIZE,
+    type=int,
+    help='Size of the in-memory buffer for each table before copying it to the database'
+)
+@click.option(
+    '--vectorized/--no-vectorized',
+    default=False,
+    type=bool,
+    help='Transform the dataset in chunks, one variable at a time (the records are loaded using COPY)'
+)
+@click.option(
+    '--chunk-size',
+    default=CHUNK_DEFAULT_SIZE,
+    type=int,
+    help='Number of rows in each chunk when using --vectorized'
+)
+@click.option(
+    '--workers',
+    default=1,
+    type=int,
+    help='Number of processes used to parse the dataset, each one with a range of rows'
+)
+@click.option(
+    '--id-block-size',
+    default=ID_BLOCK_DEFAULT_SIZE,
+    type=int,
+    help='Number of ids reserved at once from each sequence'
+)
+@click.option(
+    '--commit-every',
+    default=None,
+    type=int,
+    help='Number of rows inserted in each transaction (by default, each statement is committed)'
+)
+@click.option(
+    '--resume/--no-resume',
+    default=False,
+    type=bool,
+    help='Continue after the last row committed in a previous run with the same dataset, cohort, and start ' +
+        '(requires --commit-every, not available with --incremental)'
+)
+@click.option(
+    '--incremental/--no-incremental',
+    default=False,
+    type=bool,
+    help='Only transform the rows (for each wave) that changed since the last time, replacing the previous ' +
+        'records. Requires a source id and that the previous runs also used --incremental'
+)
+@click.option(
+    '--output-dir',
+    default=None,
+    help='Write the tables to compressed csv files in this directory instead of the database, ' +
+        'the files are loaded later with load-staging-files (requires --cohort-name)'
+)
+@click.option(
+    '--pipeline-queue-size',
+    default=None,
+    type=int,
+    help='Read the dataset and write to the database in separate threads while transforming the rows, ' +
+        'keeping up to this number of batches queued between them'
+)
+def parse_data(cohort_name, cohort_location, start, limit, convert_categoricals, drop_temp_tables, copy,
+    copy_buffer_size, vectorized, chunk_size, workers, id_block_size, commit_every, resume, incremental,
+    output_dir, pipeline_queue_size):
     """ Parse the source dataset and populate the CDM database.
         
         Important: One or more temporary tables will be created to store information only required
@@ -146,9 +230,56 @@ def parse_data(cohort_name, cohort_location, start, limit, convert_categoricals,
     """
     destination_mapping = parse_csv_mapping(os.getenv(DESTINATION_MAPPING_PATH))
     source_mapping = parse_csv_mapping(os.getenv(SOURCE_MAPPING_PATH))
+    # The checkpoint is only stored when committing the rows
+    if resume and not commit_every:
+        raise click.UsageError('The option --resume requires --commit-every')
+    # The rows with the same source id are hashed together, including the rows already parsed
+    if resume and incremental:
+        raise click.UsageError('The options --resume and --incremental can\'t be used together')
+    # The links to the source ids require a cohort, inserted when loading the files
+    if output_dir and not cohort_name:
+        raise click.UsageError('The option --output-dir requires --cohort-name')
+
+    if output_dir:
+        # Without a database, the ids are assigned locally and the cohort is
+        # only inserted when loading the files
+        if workers > 1 or resume or incremental:
+            print('The options --workers, --resume, and --incremental are ignored with --output-dir')
+        with StagingWriter(output_dir, cohort_name, cohort_location) as staging:
+            parser = DataParser(
+                source_mapping,
+                destination_mapping,
+                os.getenv(FOLLOW_UP_SUFFIX),
+                os.getenv(FOLLOW_UP_PREFIX),
+                None,
+                os.getenv(MISSING_VALUES),
+                os.getenv(IGNORE_DUPLICATES),
+                None,
+                id_block_size=id_block_size,
+                staging=staging,
+            )
+            parser.print_mapping_warnings()
+            DataParser.parse_dataset(
+                os.getenv(DATASET_PATH),
+                start,
+                limit,
+                convert_categoricals,
+                callback=parser.transform_frames if vectorized else parser.transform_rows,
+                columns=parser.get_required_columns(),
+                delimiter=os.getenv(DATASET_DELIMITER) or DEFAULT_DELIMITER,
+                copy=True,
+                copy_buffer_size=copy_buffer_size,
+                vectorized=vectorized,
+                chunk_size=chunk_size,
+                pipeline_queue_size=pipeline_queue_size,
+            )
+            staging.write_manifest(parser.allocator.get_last_ids())
+        print(f'Tables written to {output_dir}')
+        return
 
     # TODO: create the statements and commit them in batches
-    with PostgresManager() as pg:
+    # When pipelined, a second connection is used to reserve the ids
+    with PostgresPool(2 if pipeline_queue_size else 1) as pool, pool.manager() as pg:
         # Insert the cohort information
         # If the cohort is already in the DB it'll only retrieve the id
         cohort_id = None
@@ -159,38 +290,123 @@ def parse_data(cohort_name, cohort_location, start, limit, convert_categoricals,
 
         # Create the necessary temporary table
         create_id_table(pg)
+        create_checkpoint_table(pg)
+        if incremental:
+            create_row_hash_table(pg)
 
         # Parse the dataset
-        parser = DataParser(
-            source_mapping,
-            destination_mapping,
-            os.getenv(FOLLOW_UP_SUFFIX),
-            os.getenv(FOLLOW_UP_PREFIX),
-            cohort_id,
-            os.getenv(MISSING_VALUES),
-            os.getenv(IGNORE_DUPLICATES),
-            pg
-        )
-        DataParser.parse_dataset(
-            os.getenv(DATASET_PATH),
-            start,
-            limit,
-            convert_categoricals, 
-            delimiter=os.getenv(DATASET_DELIMITER) or DEFAULT_DELIMITER,
-            bulk=os.getenv(BULK),
-            bulk_range=os.getenv(BULK_RANGE) or 50,
-            callback=parser.transform_rows,
-        )
+        parse_arguments = {
+            'delimiter': os.getenv(DATASET_DELIMITER) or DEFAULT_DELIMITER,
+            'bulk': os.getenv(BULK),
+            'bulk_range': os.getenv(BULK_RANGE) or 50,
+            'copy': copy,
+            'copy_buffer_size': copy_buffer_size,
+            'vectorized': vectorized,
+            'chunk_size': chunk_size,
+            'commit_every': commit_every,
+            'pipeline_queue_size': pipeline_queue_size,
+        }
+        if workers > 1:
+            # The mappings are checked once, instead of in each worker
+            DataParser(
+                source_mapping,
+                destination_mapping,
+                os.getenv(FOLLOW_UP_SUFFIX),
+                os.getenv(FOLLOW_UP_PREFIX),
+                cohort_id,
+                os.getenv(MISSING_VALUES),
+                None,
+                None,
+            ).print_mapping_warnings()
+            # Each worker uses its own connection to the database
+            parse_dataset_parallel(workers, cohort_id, start, limit, convert_categoricals, parse_arguments,
+                id_block_size, resume, incremental)
+        else:
+            # When pipelined, the statements are sent to the database from a separate thread
+            with PipelinedWriter(pg, pipeline_queue_size) if pipeline_queue_size else nullcontext(pg) as writer, \
+                pool.manager() if pipeline_queue_size else nullcontext() as id_pg:
+                parser = DataParser(
+                    source_mapping,
+                    destination_mapping,
+                    os.getenv(FOLLOW_UP_SUFFIX),
+                    os.getenv(FOLLOW_UP_PREFIX),
+                    cohort_id,
+                    os.getenv(MISSING_VALUES),
+                    os.getenv(IGNORE_DUPLICATES),
+                    writer,
+                    id_block_size=id_block_size,
+                    incremental=incremental,
+                    id_pg=id_pg,
+                )
+                parser.print_mapping_warnings()
+                resume_start = parser.load_checkpoint(os.getenv(DATASET_PATH), start, resume)
+                if limit > 0 and resume_start >= start + limit:
+                    print('All the rows were already parsed')
+                else:
+                    if incremental:
+                        # The rows with the same source id are hashed together before transforming them
+                        DataParser.parse_dataset(
+                            os.getenv(DATASET_PATH),
+                            start,
+                            limit,
+                            convert_categoricals,
+                            parse_arguments['delimiter'],
+                            callback=parser.hash_rows,
+                            columns=parser.get_required_columns(),
+                        )
+                    DataParser.parse_dataset(
+                        os.getenv(DATASET_PATH),
+                        resume_start,
+                        limit - (resume_start - start) if limit > 0 else limit,
+                        convert_categoricals,
+                        callback=parser.transform_frames if vectorized else parser.transform_rows,
+                        columns=parser.get_required_columns(),
+                        **parse_arguments
+                    )
 
         # Dropping the temporary tables
         if drop_temp_tables:
            pg.drop_table(ID_TABLE)
 
+@cli.command()
+@click.option('--input-dir', prompt=True, help='Directory with the files written by parse-data --output-dir')
+@click.option(
+    '--copy-buffer-size',
+    default=COPY_BUFFER_DEFAULT_SIZE,
+    type=int,
+    help='Size of the in-memory buffer for each table before copying it to the database'
+)
+def load_staging_files(input_dir, copy_buffer_size):
+    """ Load the tables written by parse-data with --output-dir, moving the ids
+        to blocks reserved from the sequences. The files are copied in a
+        single transaction.
+    """
+    with PostgresManager() as pg:
+        load_staging(pg, input_dir, copy_buffer_size)
+
 @click.option('--table-name', prompt=True)
 @click.option('--cohort-id', default=None, type=int)
 @click.option('--drop-table', default=1, type=int)
+@click.option(
+    '--commit-every',
+    default=None,
+    type=int,
+    help='Number of visits inserted in each transaction (by default, each statement is committed)'
+)
+@click.option(
+    '--itersize',
+    default=STREAM_DEFAULT_ITERSIZE,
+    type=int,
+    help='Number of visits fetched at once from the database'
+)
+@click.option(
+    '--visit-batch-size',
+    default=VISIT_BATCH_DEFAULT_SIZE,
+    type=int,
+    help='Number of visits whose observations, measurements, and conditions are retrieved in a single query'
+)
 @cli.command()
-def parse_omop_to_plane(table_name, cohort_id, drop_table):
+def parse_omop_to_plane(table_name, cohort_id, drop_table, commit_every, itersize, visit_batch_size):
     """ Parse the OMOP content to a plane/simpified table. Available to 
         facilitate the first contact with SQL databases and querying. However,
         it's recommended to use the OMOP table (and develop any scripts or algorithms 
@@ -198,7 +414,9 @@ def parse_omop_to_plane(table_name, cohort_id, drop_table):
         a standard clinical model.
     """
     destination_mapping = parse_csv_mapping(os.getenv(DESTINATION_MAPPING_PATH))
-    with PostgresManager() as pg:
+    # The visits are streamed from a separate connection, kept open while
+    # the rows are committed in the other
+    with PostgresPool(2) as pool, pool.manager() as pg, pool.manager() as visits_pg:
         if drop_table:
             print("Drop table")
             pg.drop_table(table_name)
@@ -212,26 +430,37 @@ def parse_omop_to_plane(table_name, cohort_id, drop_table):
         # Parse the data from OMOP to the simplified table
         print('Parsing the OMOP CDM data to the plane table')
         parsed_visits = []
-        visits = get_visit_occurrences(pg, cohort_id)
-        for count, visit in enumerate(visits):
-            # Retrieve the observations, measurements, and conditions for each
-            # visit (visit[0] - the visit ID)
-            observations = get_observations_by_visit_id(pg, visit[0])
-            measurements = get_measurements_by_visit_id(pg, visit[0])
-            conditions = get_conditions_by_visit_id(pg, visit[0])
-            visit_values = parse_visit(
-                destination_mapping, columns, visit, observations, measurements, conditions)
-            if os.getenv(BULK):
-                parsed_visits.append(visit_values)
-                bulk_range = int(os.getenv(BULK_RANGE)) or 50
-                if len(parsed_visits) == bulk_range or count == len(visits) - 1:
+        total_visits = count_visit_occurrences(pg, cohort_id)
+        visits = get_visit_occurrences(visits_pg, cohort_id, itersize)
+        for batch in batches(enumerate(visits), commit_every):
+            with pg.transaction() if commit_every else nullcontext():
+                for visit_batch in batches(batch, visit_batch_size):
+                    visit_batch = list(visit_batch)
+                    # Retrieve the observations, measurements, and conditions for the
+                    # visits in the batch (visit[0] - the visit ID)
+                    visit_ids = [visit[0] for (_, visit) in visit_batch]
+                    observations = get_observations_by_visit_ids(pg, visit_ids)
+                    measurements = get_measurements_by_visit_ids(pg, visit_ids)
+                    conditions = get_conditions_by_visit_ids(pg, visit_ids)
+                    for count, visit in visit_batch:
+                        visit_values = parse_visit(destination_mapping, columns, visit,
+                            observations.get(visit[0], []), measurements.get(visit[0], []),
+                            conditions.get(visit[0], []))
+                        if os.getenv(BULK):
+                            parsed_visits.append(visit_values)
+                            bulk_range = int(os.getenv(BULK_RANGE)) or 50
+                            if len(parsed_visits) == bulk_range or count == total_visits - 1:
+                                insert_values(pg, table_name, parsed_visits)
+                                print(f"Bulk insert: {count + 1} rows")
+                                parsed_visits = []
+                        else:
+                            insert_values(pg, table_name, [visit_values])
+                        if (count + 1) % 1000 == 0:
+                            print(f'Processed {count + 1} visits from {total_visits}')
+                # The visits parsed are inserted before committing
+                if parsed_visits:
                     insert_values(pg, table_name, parsed_visits)
-                    print(f"Bulk insert: {count + 1} rows")
                     parsed_visits = []
-            else:
-                insert_values(pg, table_name, [visit_values])
-            if (count + 1) % 1000 == 0:
-                print(f'Processed {count + 1} visits from {len(visits)}')
 
 @click.option(
     '--convert-categoricals/--no-convert-categoricals',
@@ -34,6 +34,7 @@ IGNORE_ENCODING_ERRORS = 'IGNORE_ENCODING_ERRORS'
 ENCODING = 'ENCODING'
 MISSING_VALUES = 'MISSING_VALUES'
 IGNORE_DUPLICATES = 'IGNORE_DUPLICATES'
+DB_SETTINGS = 'DB_SETTINGS'
 
 SOURCE_MAPPING = "SOURCE_MAPPING"
 DESTINATION_MAPPING = "DESTINATION_MAPPING"
@@ -42,15 +43,75 @@ MESSAGE = "MESSAGE"
 ERROR_MESSAGE = "ERROR_MESSAGE"
 VARIABLES = "VARIABLES"
 
-BUILD = 'BUILD'
-CHECK_DUPLICATE = "CHECK_DUPLICATE"
 BULK = 'BULK'
 BULK_RANGE = 'BULK_RANGE'
+COPY = 'COPY'
+TABLE = 'TABLE'
+COLUMNS = 'COLUMNS'
+ID_COLUMN = 'ID_COLUMN'
+KEY_COLUMNS = 'KEY_COLUMNS'
+SEQUENCE = 'SEQUENCE'
+
+# Size (in characters) of the in-memory buffer for each table before it's
+# copied into the database
+COPY_BUFFER_DEFAULT_SIZE = 8 * 1024 * 1024
+COPY_NULL = '\\N'
+# Information for each shard when parsing the dataset with multiple workers
+ROWS = 'ROWS'
+START = 'START'
+END = 'END'
+
+# Number of rows in each chunk when transforming the dataset column-wise
+CHUNK_DEFAULT_SIZE = 10000
+
+# The position of the rows in a csv dataset is kept (once for each number of
+# rows) in a file next to the dataset
+ROW_INDEX_STEP = 1000
+ROW_INDEX_EXTENSION = '.idx'
+
+# Files written for each table when parsing the dataset without a database
+STAGING_EXTENSION = '.csv.gz'
+STAGING_MANIFEST = 'manifest.json'
+STAGING_COMPRESSION_LEVEL = 6
+PERSON_UPDATE_STAGING = 'person_update'
+
+# Number of batches kept in the queues between reading the dataset, transforming
+# the rows, and writing to the database when pipelined (and rows in each batch)
+PIPELINE_QUEUE_DEFAULT_SIZE = 8
+READ_AHEAD_BATCH_SIZE = 1000
+
+# Number of rows fetched at once from a server-side cursor
+STREAM_DEFAULT_ITERSIZE = 2000
+
+# Number of visits whose observations, measurements, and conditions are
+# retrieved at once when building the plane table
+VISIT_BATCH_DEFAULT_SIZE = 1000
+
+# Maximum number of connections kept by a PostgresPool
+POOL_DEFAULT_SIZE = 4
+
+# Number of new persons (and links between the source id and person id) kept
+# in memory before inserting them
+ID_RECORDS_BATCH_SIZE = 1000
+
+# Number of dates kept in the cache after being parsed
+DATE_CACHE_SIZE = 100000
+
+# Number of parsed values kept for each variable
+PARSED_VALUES_CACHE_SIZE = 10000
+
+# Number of ids reserved from a sequence at once
+ID_BLOCK_DEFAULT_SIZE = 10000
 
 VARIABLE = 'variable'
 MAPPING = 'mapping'
 
 ID_TABLE = 'person_source_id'
+CHECKPOINT_TABLE = 'parse_checkpoint'
+ROW_HASH_TABLE = 'source_row_hash'
+
+# Number of bytes read from the start and the end of the dataset to identify it
+FINGERPRINT_SIZE = 1024 * 1024
 
 PERSON_SEQUENCE = 'person_sequence'
 OBSERVATION_SEQUENCE = 'observation_sequence'
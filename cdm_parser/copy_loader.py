@@ -0,0 +1,61 @@
+import csv
+import io
+
+from cdm_builder import CDM_TABLES
+from constants import *
+
+class CopyLoader:
+    """ Loads the observations, measurements, and conditions using COPY FROM STDIN.
+        The records are written to an in-memory CSV buffer for each table and
+        copied to the database once the buffer reaches the size provided.
+        The before_flush function is called before copying the records (e.g. to
+        insert the visits referenced by the records).
+    """
+    def __init__(self, pg, buffer_size=COPY_BUFFER_DEFAULT_SIZE, before_flush=None):
+        self.pg = pg
+        self.buffer_size = int(buffer_size)
+        self.before_flush = before_flush
+        self.buffers = {}
+        self.writers = {}
+
+    def get_buffer(self, domain):
+        """ Retrieve the buffer for a domain.
+        """
+        if domain not in self.buffers:
+            self.buffers[domain] = io.StringIO()
+            self.writers[domain] = csv.writer(self.buffers[domain], lineterminator='\n')
+        return self.buffers[domain]
+
+    def add(self, domain, record):
+        """ Add a record (following the columns for the domain) to the buffer.
+        """
+        buffer = self.get_buffer(domain)
+        self.writers[domain].writerow([COPY_NULL if value is None else value for value in record])
+        if buffer.tell() >= self.buffer_size:
+            self.flush_domain(domain)
+
+    def add_frame(self, domain, frame):
+        """ Add the records in a DataFrame (with the columns for the domain) to the buffer.
+        """
+        buffer = self.get_buffer(domain)
+        frame.to_csv(buffer, header=False, index=False, na_rep=COPY_NULL)
+        if buffer.tell() >= self.buffer_size:
+            self.flush_domain(domain)
+
+    def flush_domain(self, domain):
+        """ Copy the records in the buffer for a domain to the database.
+        """
+        buffer = self.buffers.get(domain)
+        if buffer is not None and buffer.tell() > 0:
+            if self.before_flush:
+                self.before_flush()
+            buffer.seek(0)
+            self.pg.copy_from_buffer(CDM_TABLES[domain][TABLE], CDM_TABLES[domain][COLUMNS], buffer)
+            buffer.seek(0)
+            buffer.truncate()
+
+    def flush(self):
+        """ Copy all the records in the buffers to the database.
+        """
+        for domain in self.buffers.keys():
+            self.flush_domain(domain)
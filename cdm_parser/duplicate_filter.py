@@ -0,0 +1,74 @@
+from datetime import datetime
+
+import pandas as pd
+
+from cdm_builder import CDM_TABLES, get_record_keys
+from constants import *
+
+class DuplicateFilter:
+    """ Skips the observations, measurements, and conditions already included in
+        the cohort (with the same person, visit, concept, datetime, and value).
+        The records in the database are loaded once, the new records are kept in
+        memory for each person and visit.
+    """
+    def __init__(self, pg, cohort_id):
+        self.pg = pg
+        self.cohort_id = cohort_id
+        self.keys = None
+        # Position of the columns identifying the records for each domain
+        self.positions = {
+            domain: [table[COLUMNS].index(column) for column in table[KEY_COLUMNS]]
+                for domain, table in CDM_TABLES.items()
+        }
+
+    @staticmethod
+    def normalize(value):
+        """ Normalize a value, either from the records built or from the database.
+        """
+        if value is None or (not isinstance(value, str) and pd.isnull(value)):
+            return None
+        if isinstance(value, datetime):
+            return value.strftime(DATE_FORMAT)
+        if isinstance(value, bool):
+            return str(value)
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return str(value)
+
+    def load(self):
+        """ Load the records already included in the cohort.
+        """
+        self.keys = {}
+        for domain in CDM_TABLES.keys():
+            for columns in get_record_keys(self.pg, domain, self.cohort_id):
+                key = tuple(self.normalize(value) for value in columns)
+                self.keys.setdefault(key[:2], set()).add((domain,) + key[2:])
+
+    def add(self, domain, record):
+        """ Keep a new record (following the columns for the domain). Returns
+            False if the record is a duplicate.
+        """
+        if self.keys is None:
+            self.load()
+        key = tuple(self.normalize(record[position]) for position in self.positions[domain])
+        records = self.keys.setdefault(key[:2], set())
+        if (domain,) + key[2:] in records:
+            return False
+        records.add((domain,) + key[2:])
+        return True
+
+    def add_frame(self, domain, frame):
+        """ Keep the new records in a DataFrame (with the columns for the domain).
+            Returns the records that aren't duplicates.
+        """
+        return frame.loc[[self.add(domain, record) for record in frame.itertuples(index=False, name=None)]]
+
+    def remove(self, person_id, visit_ids):
+        """ Forget the records for a person in the visits provided (e.g. after
+            deleting them).
+        """
+        if self.keys is None:
+            self.load()
+        for visit_id in visit_ids:
+            self.keys.pop((self.normalize(person_id), self.normalize(visit_id)), None)
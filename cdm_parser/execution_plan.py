@@ -0,0 +1,50 @@
+from constants import *
+from utils import is_value_valid
+
+class VariablePlan:
+    """ Execution plan for a variable from the source mapping. Everything that
+        only depends on the mappings is resolved once, leaving the per-row work
+        to reading and parsing the values. The source variables refer to the
+        records for each wave (see WaveReshaper).
+    """
+    def __init__(self, variable, source, destination, build_record, date_variables=None,
+        date_format=None, additional_info=None):
+        self.variable = variable
+        self.field = destination
+        self.domain = destination[DOMAIN]
+        self.build_record = build_record
+
+        # Source variables (including the alternatives)
+        self.source_variables = []
+        if source[SOURCE_VARIABLE]:
+            self.source_variables = [source[SOURCE_VARIABLE]]
+            if source[ALTERNATIVES]:
+                self.source_variables.extend(source[ALTERNATIVES].split(DEFAULT_SEPARATOR))
+        self.static_value = source[STATIC_VALUE]
+
+        # Validation of the source values
+        self.validation = destination[VALUES_RANGE]
+        self.limit = source[LIMIT]
+        self.condition = source[CONDITION].split(DEFAULT_SEPARATOR) if is_value_valid(source[CONDITION]) else None
+
+        # Arguments to parse the value
+        self.aggregate = source[AGGREGATE]
+        self.conversion = source[CONVERSION]
+        self.threshold = source[THRESHOLD]
+        self.format = source[FORMAT]
+        self.type = destination[TYPE]
+
+        # Specific date for the variable
+        self.date_variables = date_variables
+        self.date_format = date_format
+
+        # Additional information: either a static value or a source variable
+        self.additional_info_static = None
+        self.additional_info_variable = None
+        if additional_info is not None:
+            if additional_info[STATIC_VALUE]:
+                self.additional_info_static = additional_info[STATIC_VALUE]
+            else:
+                self.additional_info_variable = additional_info[SOURCE_VARIABLE]
+        elif source[STATIC_VALUE]:
+            self.additional_info_static = source[STATIC_VALUE]
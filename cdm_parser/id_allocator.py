@@ -0,0 +1,61 @@
+from cdm_builder import reserve_ids
+from constants import *
+
+class IdAllocator:
+    """ Hands out the ids for the CDM tables from blocks reserved in the
+        database sequences, avoiding a nextval for each record. Without a
+        database, the ids are assigned locally starting from 1.
+    """
+    def __init__(self, pg, block_size=ID_BLOCK_DEFAULT_SIZE):
+        self.pg = pg
+        self.block_size = int(block_size)
+        # Next id and last id available in the block for each sequence
+        self.blocks = {}
+
+    def get_state(self):
+        """ Retrieve the ids still available in the blocks reserved.
+        """
+        return {sequence: list(block) for sequence, block in self.blocks.items()}
+
+    def set_state(self, state):
+        """ Continue from the ids available in the blocks reserved previously.
+        """
+        self.blocks = {sequence: list(block) for sequence, block in state.items()}
+
+    def get_last_ids(self):
+        """ Retrieve the last id handed out for each sequence.
+        """
+        return {sequence: block[0] - 1 for sequence, block in self.blocks.items()}
+
+    def reserve(self, sequence, size):
+        """ Reserve a new block of ids from a sequence.
+        """
+        if self.pg is None:
+            last_id = self.blocks[sequence][1] + size if sequence in self.blocks else size
+        else:
+            last_id = reserve_ids(self.pg, sequence, size)
+        self.blocks[sequence] = [last_id - size + 1, last_id]
+
+    def next_id(self, sequence):
+        """ Retrieve the next id for a sequence.
+        """
+        block = self.blocks.get(sequence)
+        if block is None or block[0] > block[1]:
+            self.reserve(sequence, self.block_size)
+            block = self.blocks[sequence]
+        block[0] += 1
+        return block[0] - 1
+
+    def next_ids(self, sequence, count):
+        """ Retrieve the next ids for a sequence (a list with count ids).
+        """
+        ids = []
+        while len(ids) < count:
+            block = self.blocks.get(sequence)
+            if block is None or block[0] > block[1]:
+                self.reserve(sequence, max(self.block_size, count - len(ids)))
+                block = self.blocks[sequence]
+            available = min(block[1] - block[0] + 1, count - len(ids))
+            ids.extend(range(block[0], block[0] + available))
+            block[0] += available
+        return ids
@@ -0,0 +1,160 @@
+import math
+import multiprocessing
+import os
+from contextlib import nullcontext
+
+import pandas as pd
+
+from constants import *
+from parse_dataset import DataParser
+from parser import parse_csv_mapping
+from pipeline import PipelinedWriter
+from postgres_manager import PostgresPool
+from row_index import get_row_offset
+from utils import is_value_valid
+
+def read_source_ids(path, id_source_variable, start, limit, convert_categoricals, delimiter):
+    """ Read the source id for each row in the range provided.
+    """
+    error_handling = 'ignore' if os.getenv(IGNORE_ENCODING_ERRORS) else 'strict'
+    source_ids = []
+    if '.csv' in path:
+        # The row index is also used by each worker to seek the start of its range
+        (offset, skip) = get_row_offset(path, start, delimiter, os.getenv(ENCODING), error_handling)
+        with open(path, 'r', errors=error_handling, encoding=os.getenv(ENCODING)) as csv_file:
+            (_, csv_reader) = DataParser.read_csv_rows(csv_file, delimiter, columns={id_source_variable},
+                offset=offset)
+            for index, row in enumerate(csv_reader, start=start - skip):
+                if limit > 0 and index - start >= limit:
+                    break
+                if index >= start:
+                    source_ids.append((index, row.get(id_source_variable)))
+    else:
+        if '.sav' in path:
+            chunks = DataParser.read_spss_chunks(path, start, limit, CHUNK_DEFAULT_SIZE, convert_categoricals,
+                columns={id_source_variable})
+        else:
+            chunks = DataParser.read_sas_chunks(path, start, limit, CHUNK_DEFAULT_SIZE, columns={id_source_variable})
+        for chunk in chunks:
+            column = chunk[id_source_variable] if id_source_variable \
+                else pd.Series(None, index=chunk.index, dtype=object)
+            source_ids.extend(column.items())
+    return source_ids
+
+def split_dataset(source_ids, workers):
+    """ Split the rows between the workers. Each source id is assigned to the
+        worker whose range includes its first occurrence, so that a participant
+        is never handled by two workers. Returns the shards with the source ids,
+        the rows without a valid source id, and the first/last row for each worker.
+    """
+    shard_size = math.ceil(len(source_ids) / workers)
+    owner = {}
+    shards = [{SOURCE_ID: set(), ROWS: set(), START: None, END: None} for _ in range(workers)]
+    for position, (index, source_id) in enumerate(source_ids):
+        worker = position // shard_size
+        if is_value_valid(source_id):
+            worker = owner.setdefault(str(source_id), worker)
+            shards[worker][SOURCE_ID].add(str(source_id))
+        else:
+            # Rows without a valid source id are skipped by the worker whose range
+            # includes them.
+            shards[worker][ROWS].add(index)
+        if shards[worker][START] is None:
+            shards[worker][START] = index
+        shards[worker][END] = index
+    return [shard for shard in shards if shard[START] is not None]
+
+def filter_shard(iterator, shard, id_source_variable):
+    """ Filter the rows that belong to a shard.
+    """
+    for index, row in iterator:
+        if (id_source_variable and id_source_variable in row and str(row[id_source_variable]) in shard[SOURCE_ID]) \
+            or index in shard[ROWS]:
+            yield (index, row)
+
+def filter_shard_frames(frames, shard, id_source_variable):
+    """ Filter the rows that belong to a shard for each chunk of the dataset.
+    """
+    for frame in frames:
+        mask = frame.index.isin(shard[ROWS])
+        if id_source_variable and id_source_variable in frame:
+            mask |= frame[id_source_variable].map(str).isin(shard[SOURCE_ID])
+        if mask.any():
+            yield frame[mask]
+
+def parse_shard(shard, cohort_id, convert_categoricals, parse_arguments, id_block_size=ID_BLOCK_DEFAULT_SIZE,
+    resume=False, incremental=False):
+    """ Parse the rows from a shard, using a new connection to the database.
+    """
+    destination_mapping = parse_csv_mapping(os.getenv(DESTINATION_MAPPING_PATH))
+    source_mapping = parse_csv_mapping(os.getenv(SOURCE_MAPPING_PATH))
+    pipeline_queue_size = parse_arguments.get('pipeline_queue_size')
+    with PostgresPool(2 if pipeline_queue_size else 1) as pool, pool.manager() as pg, \
+        PipelinedWriter(pg, pipeline_queue_size) if pipeline_queue_size else nullcontext(pg) as writer, \
+        pool.manager() if pipeline_queue_size else nullcontext() as id_pg:
+        parser = DataParser(
+            source_mapping,
+            destination_mapping,
+            os.getenv(FOLLOW_UP_SUFFIX),
+            os.getenv(FOLLOW_UP_PREFIX),
+            cohort_id,
+            os.getenv(MISSING_VALUES),
+            os.getenv(IGNORE_DUPLICATES),
+            writer,
+            id_block_size=id_block_size,
+            incremental=incremental,
+            id_pg=id_pg,
+        )
+        id_source_variable = parser.get_source_variable(SOURCE_ID)
+        if parse_arguments.get('vectorized'):
+            callback = lambda frames, **kwargs: parser.transform_frames(
+                filter_shard_frames(frames, shard, id_source_variable), **kwargs)
+        else:
+            callback = lambda iterator, **kwargs: parser.transform_rows(
+                filter_shard(iterator, shard, id_source_variable), **kwargs)
+        # The progress is kept for each shard
+        start = parser.load_checkpoint(os.getenv(DATASET_PATH), shard[START], resume)
+        if start > shard[END]:
+            print(f'All the rows from {shard[START]} to {shard[END]} were already parsed')
+            return
+        if incremental:
+            # The rows with the same source id are hashed together before transforming them
+            DataParser.parse_dataset(
+                os.getenv(DATASET_PATH),
+                start,
+                shard[END] - start + 1,
+                convert_categoricals,
+                parse_arguments['delimiter'],
+                callback=lambda iterator, **kwargs: parser.hash_rows(
+                    filter_shard(iterator, shard, id_source_variable), **kwargs),
+                columns=parser.get_required_columns(),
+            )
+        DataParser.parse_dataset(
+            os.getenv(DATASET_PATH),
+            start,
+            shard[END] - start + 1,
+            convert_categoricals,
+            callback=callback,
+            columns=parser.get_required_columns(),
+            **parse_arguments
+        )
+
+def parse_dataset_parallel(workers, cohort_id, start, limit, convert_categoricals, parse_arguments,
+    id_block_size=ID_BLOCK_DEFAULT_SIZE, resume=False, incremental=False):
+    """ Parse the dataset using multiple processes, each one transforming a range
+        of rows with its own connection to the database.
+    """
+    source_mapping = parse_csv_mapping(os.getenv(SOURCE_MAPPING_PATH))
+    id_source_variable = source_mapping[SOURCE_ID][SOURCE_VARIABLE] if SOURCE_ID in source_mapping else None
+    # Without a source id, each row represents a different person.
+    source_ids = read_source_ids(os.getenv(DATASET_PATH), id_source_variable, start, limit,
+        convert_categoricals, parse_arguments['delimiter'])
+    shards = split_dataset(source_ids, workers)
+    print(f'Parsing {len(source_ids)} rows using {len(shards)} workers')
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(len(shards)) as pool:
+        pool.starmap(
+            parse_shard,
+            [(shard, cohort_id, convert_categoricals, parse_arguments, id_block_size, resume, incremental)
+                for shard in shards]
+        )
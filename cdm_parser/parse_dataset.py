@@ -1,54 +1,79 @@
+from contextlib import closing, nullcontext
+from itertools import chain, takewhile
 from operator import le, lt, ge, gt
 
 import csv
+import hashlib
+import json
 import pandas as pd
+import pyreadstat
 
 from cdm_builder import *
 from constants import *
+from copy_loader import CopyLoader
+from duplicate_filter import DuplicateFilter
 from exceptions import ParsingError
-from utils import arrays_to_dict, parse_date, get_year_of_birth, parse_float, is_value_valid
-
-CDM_SQL = {
-    CONDITION_OCCURRENCE: {
-        BUILD: build_condition,
-        CHECK_DUPLICATE: check_duplicated_condition,
-    },
-    MEASUREMENT: {
-        BUILD: build_measurement,
-        CHECK_DUPLICATE: check_duplicated_measurement,
-    },
-    OBSERVATION: {
-        BUILD: build_observation,
-        CHECK_DUPLICATE: check_duplicated_observation,
-    },
-}
+from execution_plan import VariablePlan
+from id_allocator import IdAllocator
+from row_index import get_row_offset
+from vectorized_transform import FrameTransformer
+from wave_reshaper import WaveReshaper
+from utils import arrays_to_dict, batches, get_dataset_fingerprint, parse_date, get_year_of_birth, parse_float, \
+    is_flag_set, is_value_valid, read_ahead
 
-CDM_SQL_VALUES = {
-    CONDITION_OCCURRENCE: {
-        BUILD: build_condition_values,
-        BULK: build_condition_bulk,
-    },
-    MEASUREMENT: {
-        BUILD: build_measurement_values,
-        BULK: build_measurement_bulk,
-    },
-    OBSERVATION: {
-        BUILD: build_observation_values,
-        BULK: build_observation_bulk,
-    },
+CDM_SQL_RECORDS = {
+    CONDITION_OCCURRENCE: build_condition_record,
+    MEASUREMENT: build_measurement_record,
+    OBSERVATION: build_observation_record,
 }
 
 class DataParser:
     """ Parses the dataset to the OMOP CDM.
     """
     def __init__(self, source_mapping, destination_mapping,
-        fu_suffix, fu_prefix, cohort_id, missing_values, ignore_duplicate, pg):
+        fu_suffix, fu_prefix, cohort_id, missing_values, ignore_duplicate, pg, id_block_size=ID_BLOCK_DEFAULT_SIZE,
+        incremental=False, staging=None, id_pg=None):
         self.source_mapping = source_mapping
         self.destination_mapping = destination_mapping
         self.cohort_id = cohort_id
         self.ignore_duplicate = ignore_duplicate
+        # The observations/measurements/conditions already in the cohort are skipped
+        self.duplicates = DuplicateFilter(pg, cohort_id) if pg and is_flag_set(ignore_duplicate) else None
         self.pg = pg
+        # Without a database, the tables are written to files (see StagingWriter)
+        self.staging = staging
         self.warnings = []
+        self.mapping_warnings = []
+        # The ids are reserved in blocks from the sequences and assigned locally,
+        # a separate connection can be provided to reserve the blocks
+        self.allocator = IdAllocator(id_pg or pg, id_block_size) if pg or staging else None
+        # Link between the source id and the person id for the cohort, the new
+        # persons and links are inserted in batches
+        self.person_ids = None
+        self.id_records = []
+        self.person_records = {}
+        # Death datetime for each person in the cohort, the changes are updated
+        # in batches
+        self.death_datetimes = {}
+        self.person_updates = {}
+        # Visit id for each person and date in the cohort, the new visits are
+        # inserted in batches (before the records referencing them)
+        self.visit_ids = None
+        self.visit_records = []
+        # Dataset and first row used to keep the progress, see load_checkpoint
+        self.checkpoint = None
+        # When incremental, only the waves that changed since the last time are
+        # transformed. The rows with the same source id are hashed together before
+        # transforming the dataset (see hash_rows and get_changed_records)
+        self.incremental = incremental
+        self.row_hashes = None
+        self.source_hashes = None
+        self.source_rows = {}
+        self.changed_waves = {}
+        self.row_changes = {}
+        self.hash_records = set()
+        self.retractions = {}
+        self.retracted_visits = {}
 
         # Keywords used as missing values
         self.missing_values = missing_values.split(';') if missing_values else []
@@ -62,9 +87,16 @@ class DataParser:
         self.fu_prefix = []
         if fu_prefix:
             self.fu_prefix.extend(fu_prefix.split(DEFAULT_SEPARATOR))
+        # Each wave is represented by a prefix and a suffix, following the
+        # order used to parse the follow ups (prefixes first).
+        self.waves = [(prefix, '') for prefix in self.fu_prefix] + [('', suffix) for suffix in self.fu_suffix]
         # Retrieve the necessary information from the mappings
         self.value_mapping = self.create_value_mapping()
+        # Results from parsing the values for each variable
+        self.parsed_values = {}
         (self.date_source_variables, self.date_format, _) = self.get_parameters(DATE, with_format=True)
+        self.reshaper = WaveReshaper(self.waves, self.get_source_variables())
+        self.plans = self.compile_plans()
 
     @staticmethod
     def variable_values_to_dict(keys, values, separator=DEFAULT_SEPARATOR):
@@ -117,8 +149,13 @@ class DataParser:
                         (not validation or DataParser.validate_value(row[variable], validation)))
 
     @staticmethod
-    def parse_dataset(path, start, limit, convert_categoricals, delimiter, callback, bulk=False, bulk_range=1):
-        """ Read the dataset according to the file type
+    def parse_dataset(path, start, limit, convert_categoricals, delimiter, callback, bulk=False, bulk_range=1,
+        copy=False, copy_buffer_size=COPY_BUFFER_DEFAULT_SIZE, vectorized=False, chunk_size=CHUNK_DEFAULT_SIZE,
+        commit_every=None, columns=None, pipeline_queue_size=None):
+        """ Read the dataset according to the file type. When vectorized, the callback
+            receives the chunks of the dataset (DataFrames) instead of the rows.
+            If the columns are provided, only those columns are read. If the
+            pipeline_queue_size is provided, the dataset is read in a separate thread.
         """
         error_handling = 'ignore' if os.getenv(IGNORE_ENCODING_ERRORS) else 'strict'
         header = None
@@ -127,28 +164,140 @@ class DataParser:
             'limit': limit,
             'bulk': bulk,
             'bulk_range': int(bulk_range),
+            'copy': copy,
+            'copy_buffer_size': int(copy_buffer_size),
+            'commit_every': int(commit_every) if commit_every else None,
         }
-        if '.csv' in path:
+
+        def read(iterator, batch_size=READ_AHEAD_BATCH_SIZE):
+            # The reader thread is stopped once the callback returns
+            if pipeline_queue_size:
+                return closing(read_ahead(iterator, pipeline_queue_size, batch_size))
+            return nullcontext(iterator)
+
+        if '.csv' in path and vectorized:
+            header = pd.read_csv(path, sep=delimiter, dtype=str, encoding=os.getenv(ENCODING), nrows=0).columns
+            # Seek the closest indexed row before the start
+            (offset, skip) = get_row_offset(path, start, delimiter, os.getenv(ENCODING), error_handling)
             with open(path, 'r', errors=error_handling, encoding=os.getenv(ENCODING)) as csv_file:
-                csv_reader = csv.DictReader(csv_file, delimiter=delimiter)
-                for i in range(start):
+                if offset is not None:
+                    csv_file.seek(offset)
+                # Read every value as a string, as done by the csv reader
+                reader = pd.read_csv(csv_file, sep=delimiter, dtype=str, keep_default_na=False,
+                    header=None if offset is not None else 0, names=header if offset is not None else None,
+                    chunksize=chunk_size, usecols=(lambda column: column in columns) if columns is not None else None)
+                with read(DataParser.index_chunks(reader, start, skip), batch_size=1) as frames:
+                    callback(frames, **kwargs)
+        elif '.csv' in path:
+            # Seek the closest indexed row before the start
+            (offset, skip) = get_row_offset(path, start, delimiter, os.getenv(ENCODING), error_handling)
+            with open(path, 'r', errors=error_handling, encoding=os.getenv(ENCODING)) as csv_file:
+                (header, csv_reader) = DataParser.read_csv_rows(csv_file, delimiter, columns, offset)
+                for i in range(skip):
                     next(csv_reader)
-                callback(enumerate(csv_reader, start=start), **kwargs)
-                header = csv_reader.fieldnames
+                with read(enumerate(csv_reader, start=start)) as rows:
+                    callback(rows, **kwargs)
             # Alternative:
             # df = pd.read_csv(path, encoding=os.getenv(ENCODING), on_bad_lines='skip', delimiter=delimiter)
             # callback(df.loc[start:].iterrows(), **kwargs)
             # header = df.head()
-        elif '.sav' in path:
-            df = pd.read_spss(path, convert_categoricals=convert_categoricals)
-            callback(df.loc[start:].iterrows(), **kwargs)
-            header = df.head()
-        elif '.sas' in path:
-            df = pd.read_sas(path, encoding=os.getenv(ENCODING))
-            callback(df.loc[start:].iterrows(), **kwargs)
-            header = df.head()
+        elif '.sav' in path or '.sas' in path:
+            # The file is read in chunks (starting from the row provided)
+            if '.sav' in path:
+                chunks = DataParser.read_spss_chunks(path, start, limit, chunk_size, convert_categoricals, columns)
+                header = pyreadstat.read_sav(path, metadataonly=True)[1].column_names
+            else:
+                chunks = DataParser.read_sas_chunks(path, start, limit, chunk_size, columns)
+                with pd.read_sas(path, encoding=os.getenv(ENCODING), chunksize=1) as reader:
+                    header = reader.read(1).columns
+            if vectorized:
+                with read(chunks, batch_size=1) as frames:
+                    callback(frames, **kwargs)
+            else:
+                with read(chain.from_iterable(chunk.iterrows() for chunk in chunks)) as rows:
+                    callback(rows, **kwargs)
+        else:
+            raise ParsingError(f'Unsupported file type for the dataset {path} (expected .csv, .sav, or .sas)')
         return header
 
+    @staticmethod
+    def read_csv_rows(csv_file, delimiter, columns=None, offset=None):
+        """ Read the rows from a csv file as dictionaries, only including the
+            columns provided. Returns the header and the rows, starting from the
+            position (in bytes) provided or after the header.
+        """
+        csv_reader = csv.reader(csv_file, delimiter=delimiter)
+        header = next(csv_reader, [])
+        if offset is not None:
+            csv_file.seek(offset)
+        positions = [(position, name) for position, name in enumerate(header) if columns is None or name in columns]
+
+        def rows():
+            for values in csv_reader:
+                # Empty lines are skipped, as done by csv.DictReader
+                if values:
+                    yield {name: values[position] if position < len(values) else None for position, name in positions}
+
+        return (header, rows())
+
+    @staticmethod
+    def read_spss_chunks(path, start, limit, chunk_size, convert_categoricals, columns=None):
+        """ Read a SPSS file in chunks (DataFrames indexed by the row number in
+            the dataset), starting from the row provided.
+        """
+        usecols = None
+        if columns is not None:
+            column_names = pyreadstat.read_sav(path, metadataonly=True)[1].column_names
+            # At least one column is read, otherwise no rows are returned
+            usecols = [column for column in column_names if column in columns] or column_names[:1]
+        offset = start
+        while limit <= 0 or offset < start + limit:
+            row_limit = chunk_size if limit <= 0 else min(chunk_size, start + limit - offset)
+            chunk, _ = pyreadstat.read_sav(path, row_offset=offset, row_limit=row_limit, usecols=usecols,
+                apply_value_formats=convert_categoricals)
+            if len(chunk) == 0:
+                break
+            chunk.index = range(offset, offset + len(chunk))
+            offset += len(chunk)
+            yield chunk
+            if len(chunk) < row_limit:
+                break
+
+    @staticmethod
+    def read_sas_chunks(path, start, limit, chunk_size, columns=None):
+        """ Read a SAS file in chunks (DataFrames indexed by the row number in
+            the dataset), starting from the row provided. The SAS reader doesn't
+            allow to skip rows, the chunks before the start are discarded.
+        """
+        offset = 0
+        with pd.read_sas(path, encoding=os.getenv(ENCODING), chunksize=chunk_size) as reader:
+            for chunk in reader:
+                chunk.index = range(offset, offset + len(chunk))
+                offset += len(chunk)
+                chunk = chunk.loc[start:start + limit - 1 if limit > 0 else None]
+                if columns is not None:
+                    chunk = chunk[[column for column in chunk.columns if column in columns]]
+                if len(chunk) > 0:
+                    yield chunk
+                if limit > 0 and offset >= start + limit:
+                    break
+
+    @staticmethod
+    def index_chunks(chunks, start, skip=0):
+        """ Index the chunks read from a file by the row number in the dataset,
+            skipping the number of rows provided first.
+        """
+        for chunk in chunks:
+            if skip > 0:
+                skipped = min(skip, len(chunk))
+                chunk = chunk.iloc[skipped:]
+                skip -= skipped
+                if len(chunk) == 0:
+                    continue
+            chunk.index = range(start, start + len(chunk))
+            start += len(chunk)
+            yield chunk
+
     @staticmethod
     def parse_source_value(source_values):
         """ Parse the source value to keep store it in the DB.
@@ -197,6 +346,44 @@ class DataParser:
                     raise ParsingError(f'Error creating the value mapping for variable {key}: {str(error)}')
         return value_mapping
 
+    def compile_plans(self):
+        """ Compile the source and destination mappings into the list of variable
+            plans executed for each row. The variables skipped are kept in the
+            mapping warnings (see print_mapping_warnings).
+        """
+        plans = []
+        for key, value in self.source_mapping.items():
+            if key not in self.destination_mapping:
+                if DATE not in key.lower() and key not in self.warnings:
+                    self.mapping_warnings.append(f'Skipped variable {key} since its not mapped')
+                    self.warnings.append(key)
+            elif self.destination_mapping[key][DOMAIN] not in CDM_SQL_RECORDS:
+                if self.destination_mapping[key][DOMAIN] not in [PERSON, NOT_APPLICABLE] and \
+                    key not in self.warnings:
+                    self.mapping_warnings.append(f'Skipped variable {key} since its domain is not currently accepted')
+                    self.warnings.append(key)
+            else:
+                domain = self.destination_mapping[key][DOMAIN]
+                (source_dates, source_date_format, _) = self.get_parameters(self.destination_mapping[key][DATE])
+                additional_info = self.destination_mapping[key][ADDITIONAL_INFO]
+                plans.append(VariablePlan(
+                    key,
+                    value,
+                    self.destination_mapping[key],
+                    CDM_SQL_RECORDS[domain],
+                    date_variables=source_dates,
+                    date_format=source_date_format or self.date_format,
+                    additional_info=self.source_mapping[additional_info] \
+                        if additional_info and additional_info in self.source_mapping else None,
+                ))
+        return plans
+
+    def print_mapping_warnings(self):
+        """ Report the variables skipped when compiling the plans.
+        """
+        for warning in self.mapping_warnings:
+            print(warning)
+
     def get_parameters(self, parameter, with_format=False):
         """ Returns the source variable and format for a parameter.
         """
@@ -218,7 +405,33 @@ class DataParser:
 
     def get_parsed_value(self, variable, value, aggregate=None, conversion=None, threshold=None, source_variable=None,
         format=None, type=None, prefix=None, suffix=None):
-        """ Get the parsed value for a variable.
+        """ Get the parsed value for a variable. The results (and errors) are kept
+            for each variable, limited to a number of values (the key includes the
+            source variable and wave, so a mapped variable may also have many keys).
+        """
+        if aggregate:
+            return self.parse_value(variable, value, aggregate, conversion, threshold, source_variable,
+                format, type, prefix, suffix)
+        parsed_values = self.parsed_values.setdefault(variable, {})
+        # The type is included, since 1 and 1.0 are the same key but parsed differently
+        key = (value, value.__class__, conversion, threshold, source_variable, format, type, prefix, suffix)
+        if key in parsed_values:
+            result = parsed_values[key]
+        else:
+            try:
+                result = self.parse_value(variable, value, aggregate, conversion, threshold, source_variable,
+                    format, type, prefix, suffix)
+            except ParsingError as error:
+                result = error
+            if len(parsed_values) < PARSED_VALUES_CACHE_SIZE:
+                parsed_values[key] = result
+        if isinstance(result, ParsingError):
+            raise ParsingError(result.message)
+        return result
+
+    def parse_value(self, variable, value, aggregate=None, conversion=None, threshold=None, source_variable=None,
+        format=None, type=None, prefix=None, suffix=None):
+        """ Parse the value for a variable.
         """
         # TODO: convoluted function, too many return statements
         # Convert symbols to standard codes
@@ -309,6 +522,23 @@ class DataParser:
                         death_datetime = DATE_DEFAULT
         return death_datetime
 
+    def get_source_variables(self):
+        """ Retrieve the source variables in the mappings, including the alternatives.
+        """
+        source_variables = []
+        for value in self.source_mapping.values():
+            if value[SOURCE_VARIABLE]:
+                source_variables.append(value[SOURCE_VARIABLE])
+                if value[ALTERNATIVES]:
+                    source_variables.extend(value[ALTERNATIVES].split(DEFAULT_SEPARATOR))
+        return list(dict.fromkeys(source_variables))
+
+    def get_required_columns(self):
+        """ Retrieve the columns from the dataset required by the mappings,
+            including the alternatives and the follow ups.
+        """
+        return self.reshaper.get_required_columns()
+
     def get_source_variable(self, variable):
         """ Check if there is a map for the source id.
         """
@@ -373,53 +603,358 @@ class DataParser:
         if not birth_year:
             raise ParsingError('Missing required information, the row should contain the year of birth.')
 
-        # Add a new entry for the person/patient
-        person_sql = build_person(
-            self.get_parsed_value(GENDER, row[sex_source_variable])[1],
-            birth_year,
-            self.cohort_id,
-            self.get_death_datetime(row),
-        )
-        person_id = self.pg.run_sql(*person_sql, fetch_one=True)
+        # Add a new entry for the person/patient, inserted with the next batch
+        person_id = self.allocator.next_id(PERSON_SEQUENCE)
+        self.person_records[person_id] = {
+            'person_id': person_id,
+            'gender': self.get_parsed_value(GENDER, row[sex_source_variable])[1],
+            'year_of_birth': birth_year,
+            'death_datetime': self.get_death_datetime(row),
+            'cohort_id': self.cohort_id,
+        }
+        self.death_datetimes[person_id] = self.person_records[person_id]['death_datetime']
+        if len(self.person_records) >= ID_RECORDS_BATCH_SIZE:
+            self.flush_persons()
 
         return person_id
 
     def update_person(self, person_id, row):
-        """ Update a person if new information is available.
+        """ Update a person if new information is available. The persons
+            not inserted yet are updated before the insert, otherwise the
+            update is kept until the next batch.
         """
         death_datetime = self.get_death_datetime(row)
-        if death_datetime:
-            self.pg.run_sql(*update_person(person_id, death_datetime))
+        if death_datetime and death_datetime != self.death_datetimes.get(person_id):
+            self.death_datetimes[person_id] = death_datetime
+            if person_id in self.person_records:
+                self.person_records[person_id]['death_datetime'] = death_datetime
+            else:
+                self.person_updates[person_id] = death_datetime
+                if len(self.person_updates) >= ID_RECORDS_BATCH_SIZE:
+                    self.flush_person_updates()
 
-    def get_visits(self, row, person_id, suffix='', prefix=''):
+    def flush_person_updates(self):
+        """ Update the persons with a new death datetime.
+        """
+        if self.person_updates:
+            if self.staging:
+                self.staging.write_records(PERSON_UPDATE_STAGING, ('person_id', 'death_datetime'),
+                    self.person_updates.items())
+            else:
+                update_persons(list(self.person_updates.items()), self.pg)
+            self.person_updates = {}
+
+    def flush_persons(self):
+        """ Insert the new persons along with the links between the source id
+            and the person id, so that both are committed together.
+        """
+        if self.person_records:
+            if self.staging:
+                self.staging.write_records('PERSON', PERSON_COLUMNS,
+                    [build_person_record(person) for person in self.person_records.values()])
+            else:
+                insert_persons(list(self.person_records.values()), self.pg)
+            self.person_records = {}
+        if self.id_records:
+            if self.staging:
+                self.staging.write_records(ID_TABLE, ID_TABLE_COLUMNS, self.id_records)
+            else:
+                insert_id_records(self.id_records, self.pg)
+            self.id_records = []
+
+    def load_visit_ids(self):
+        """ Load the visits already included in the cohort.
+        """
+        self.visit_ids = {}
+        if not self.pg:
+            return
+        for (person_id, visit_start, visit_id) in get_visits_by_cohort(self.pg, self.cohort_id):
+            self.visit_ids.setdefault((person_id, visit_start.strftime(DATE_FORMAT)), visit_id)
+
+    def get_visit_id(self, person_id, visit_date):
+        """ Retrieve the visit for a person in a specific date, creating a new
+            visit if needed.
+        """
+        if self.visit_ids is None:
+            self.load_visit_ids()
+        key = (person_id, visit_date)
+        if key not in self.visit_ids:
+            visit_id = self.allocator.next_id(VISIT_OCCURRENCE)
+            self.visit_ids[key] = visit_id
+            self.visit_records.append({
+                'visit_id': visit_id,
+                'person_id': person_id,
+                'start_date': visit_date,
+                'end_date': visit_date,
+                'cohort_id': self.cohort_id,
+            })
+        return self.visit_ids[key]
+
+    def flush_visits(self):
+        """ Insert the new visits (and the persons referenced), deleting the
+            previous records when transforming the source rows again.
+        """
+        self.flush_persons()
+        self.retract_records()
+        if self.visit_records:
+            if self.staging:
+                self.staging.write_records('VISIT_OCCURRENCE', VISIT_OCCURRENCE_COLUMNS,
+                    [build_visit_occurrence_record(visit) for visit in self.visit_records])
+            else:
+                insert_visit_occurrences(self.visit_records, self.pg)
+            self.visit_records = []
+
+    def get_visits(self, record, person_id, wave=('', '')):
         """ Retrieve existing visit dates or parse the available dates and
-            create new visits. A suffix can be provided to get/parse 
-            visits for the follow ups.
+            create new visits. The record includes the values for a wave (prefix
+            and suffix), the baseline or one of the follow ups.
         """
         # Parse the date for the observation/measurement/condition if available
         # TODO: Calculating the end data when provided with a period for the wave
         visits = {}
-        for date_source_variable in self.date_source_variables:
-            date_variable = prefix + date_source_variable + suffix
-            if date_variable in row and row[date_variable] and is_value_valid(row[date_variable]):
-                visit_id = None
+        for date_variable in self.date_source_variables:
+            if date_variable in record and record[date_variable] and is_value_valid(record[date_variable]):
                 try:
-                    visit_date = parse_date(str(row[date_variable]), self.date_format, DATE_FORMAT)
-                    visit_id = get_visit_by_person_and_date(self.pg, person_id, visit_date)
-                    if not visit_id:
-                        visit_id = insert_visit_occurrence(person_id, visit_date, visit_date, self.cohort_id, self.pg)
-                    visits[date_variable] = visit_id
+                    visit_date = parse_date(str(record[date_variable]), self.date_format, DATE_FORMAT)
+                    visits[date_variable] = self.get_visit_id(person_id, visit_date)
                 except Exception as error:
-                    print(f"Error while trying to parse a date from the following variable {date_variable}" + \
+                    print("Error while trying to parse a date from the following variable " + \
+                          f"{self.reshaper.get_column(wave, date_variable)}" + \
                           f"(person id: {person_id}): {str(error)}")
         return visits
 
-    def transform_rows(self, iterator, start, limit, bulk=False, bulk_range=50):
-        """ Transform each row in the dataset
+    def load_person_ids(self):
+        """ Load the link between the source id and the person id (and the
+            death datetime) for the persons already included in the cohort.
+        """
+        self.person_ids = {}
+        if not self.pg:
+            return
+        for (source_id, person_id, death_datetime) in get_person_ids(self.cohort_id, self.pg):
+            self.person_ids.setdefault(source_id, person_id)
+            self.death_datetimes[person_id] = death_datetime.strftime(DATE_FORMAT) if death_datetime else None
+
+    def add_id_record(self, source_id, person_id):
+        """ Keep the link between the source id and a new person, inserting the
+            links in the temporary table with the persons.
+        """
+        self.person_ids[source_id] = person_id
+        self.id_records.append((person_id, source_id, str(self.cohort_id)))
+        if len(self.id_records) >= ID_RECORDS_BATCH_SIZE:
+            self.flush_persons()
+
+    def get_person(self, index, row, id_source_variable):
+        """ Retrieve the person id for the row, creating a new person if needed.
+        """
+        # Check if the source id variable is provided. In that case,
+        # the link between the source id and the person id will be stored
+        # in a dictionary and in a temporary table.
+        person_id = None
+        # TODO: also provide the source id when there is an error
+        if id_source_variable:
+            if not self.valid_row_value(id_source_variable, row):
+                raise ParsingError(
+                    f'Error when parsing the source id ({id_source_variable}) for record number {index}.')
+            if self.person_ids is None:
+                self.load_person_ids()
+            source_id = str(row[id_source_variable])
+            if source_id in self.person_ids:
+                person_id = self.person_ids[source_id]
+                self.update_person(person_id, row)
+            else:
+                person_id = self.parse_person(row)
+                self.add_id_record(source_id, person_id)
+        else:
+            # print('No ID variable available')
+            person_id = self.parse_person(row)
+        return person_id
+
+    def insert_bulk(self, insert_statements, bulk_range):
+        """ Insert the observations/measurements/conditions statements in bulk.
+        """
+        # print(f"Bulk insert: {bulk_insert_records} records")
+        for sql_domain in insert_statements.keys():
+            insert_records_bulk(sql_domain, insert_statements[sql_domain], self.pg, page_size=bulk_range)
+            insert_statements[sql_domain] = []
+
+    def load_row_hashes(self):
+        """ Load the hash and visits for each wave of the source ids already
+            included in the cohort.
+        """
+        self.row_hashes = {}
+        for (source_id, prefix, suffix, row_hash, visit_ids) in get_row_hashes(self.cohort_id, self.pg):
+            self.row_hashes[(source_id, (prefix, suffix))] = (row_hash, set(visit_ids or []))
+
+    @staticmethod
+    def get_record_hash(record):
+        """ Calculate the hash for the values in a record.
+        """
+        values = [(variable, str(record[variable])) for variable in sorted(record.keys())]
+        return hashlib.sha1(json.dumps(values).encode()).hexdigest()
+
+    def hash_rows(self, iterator, start, limit, **kwargs):
+        """ Calculate the hash for each wave of the source ids, combining the rows
+            with the same source id (regardless of their order), and count the
+            rows for each source id. Used as the callback for parse_dataset
+            before transforming the same rows when incremental.
+        """
+        self.source_hashes = {}
+        self.source_rows = {}
+        id_source_variable = self.get_source_variable(SOURCE_ID)
+        if not id_source_variable:
+            return
+        rows = takewhile(lambda item: limit <= 0 or item[0] - start < limit, iterator)
+        for index, row in rows:
+            if not self.valid_row_value(id_source_variable, row):
+                continue
+            source_id = str(row[id_source_variable])
+            self.source_rows[source_id] = self.source_rows.get(source_id, 0) + 1
+            for (wave, record) in self.reshaper.reshape_row(row):
+                key = (source_id, wave)
+                # The sum of the hashes (as a 160 bits number) for the rows
+                self.source_hashes[key] = (self.source_hashes.get(key, 0) + int(self.get_record_hash(record), 16)) \
+                    % (1 << 160)
+        self.source_hashes = {key: format(value, '040x') for key, value in self.source_hashes.items()}
+
+    def get_changed_waves(self, source_id, person_id, waves):
+        """ Select the waves for a source id that changed since the last time,
+            keeping the previous records to be deleted. The waves sharing a visit
+            with a changed wave are also transformed again.
+        """
+        changed_waves = set()
+        changed_visits = set()
+        for wave in waves:
+            (previous_hash, visit_ids) = self.row_hashes.get((source_id, wave), (None, set()))
+            if self.source_hashes[(source_id, wave)] != previous_hash:
+                changed_waves.add(wave)
+                changed_visits |= visit_ids
+        shared_waves = True
+        while shared_waves:
+            shared_waves = {wave for wave in waves if wave not in changed_waves
+                and self.row_hashes.get((source_id, wave), (None, set()))[1] & changed_visits}
+            for wave in shared_waves:
+                changed_waves.add(wave)
+                changed_visits |= self.row_hashes[(source_id, wave)][1]
+        for wave in changed_waves:
+            visit_ids = self.row_hashes.get((source_id, wave), (None, set()))[1]
+            if visit_ids:
+                self.retractions.setdefault(person_id, set()).update(visit_ids)
+                self.retracted_visits.setdefault(source_id, set()).update(visit_ids)
+                if self.duplicates is not None:
+                    self.duplicates.remove(person_id, visit_ids)
+            # The visits are collected from every row with the source id
+            self.row_hashes[(source_id, wave)] = (self.source_hashes[(source_id, wave)], set())
+            self.hash_records.add((source_id, wave))
+        return changed_waves
+
+    def get_changed_records(self, row, person_id, wave_records, id_source_variable):
+        """ Select the records (one for each wave) from a row for the waves that
+            changed since the last time. The rows with the same source id are
+            hashed together (see hash_rows), so the changes are found once for
+            the first row with each source id.
+        """
+        if not id_source_variable:
+            return wave_records
+        if self.row_hashes is None:
+            self.load_row_hashes()
+        source_id = str(row[id_source_variable])
+        if source_id not in self.changed_waves:
+            self.changed_waves[source_id] = self.get_changed_waves(
+                source_id, person_id, [wave for (wave, _) in wave_records])
+        self.source_rows[source_id] -= 1
+        if self.source_rows[source_id] == 0:
+            # The hash is stored once every row with the source id is transformed
+            self.hash_records.update((source_id, wave) for wave in self.changed_waves[source_id])
+        self.row_changes = {wave: source_id for wave in self.changed_waves[source_id]}
+        return [(wave, record) for (wave, record) in wave_records if wave in self.row_changes]
+
+    def add_row_hash(self, wave, visits):
+        """ Keep the visits for a wave transformed again.
+        """
+        if wave in self.row_changes:
+            source_id = self.row_changes[wave]
+            self.row_hashes[(source_id, wave)][1].update(visits.values())
+            self.hash_records.add((source_id, wave))
+
+    def retract_records(self):
+        """ Delete the observations, measurements, and conditions from the previous
+            records (before inserting the new ones).
+        """
+        if self.retractions:
+            delete_records(self.retractions.keys(), set().union(*self.retractions.values()), self.pg)
+            self.retractions = {}
+
+    def flush_row_hashes(self):
+        """ Store the hash and the visits for the waves transformed, deleting the
+            previous visits no longer in use. Until every row with the source id
+            is transformed, an empty hash (along with the previous visits) is
+            stored so the waves are transformed again if the parsing is interrupted.
+        """
+        if not self.hash_records:
+            return
+        row_hashes = []
+        completed = set()
+        for (source_id, wave) in self.hash_records:
+            (row_hash, visit_ids) = self.row_hashes[(source_id, wave)]
+            if self.source_rows[source_id] == 0:
+                completed.add(source_id)
+            else:
+                (row_hash, visit_ids) = ('', visit_ids | self.retracted_visits.get(source_id, set()))
+            row_hashes.append((str(self.cohort_id), source_id, wave[0], wave[1], row_hash, sorted(visit_ids)))
+        save_row_hashes(row_hashes, self.pg)
+        self.hash_records = set()
+        unused_visits = set()
+        for source_id in completed & self.retracted_visits.keys():
+            visits_in_use = set().union(
+                *[self.row_hashes[(source_id, wave)][1] for wave in self.changed_waves[source_id]])
+            unused_visits |= self.retracted_visits.pop(source_id) - visits_in_use
+        if unused_visits:
+            delete_visits(unused_visits, self.pg)
+
+    def load_checkpoint(self, path, start, resume=False):
+        """ Keep the progress (the last row committed and the ids reserved) when
+            parsing the dataset from the row provided. When resuming, the ids
+            reserved are restored and the row after the last one committed is
+            returned, otherwise the row provided.
+        """
+        self.checkpoint = (get_dataset_fingerprint(path), start)
+        if resume:
+            checkpoint = get_checkpoint(self.pg, self.cohort_id, *self.checkpoint)
+            if checkpoint:
+                (last_row, allocator) = checkpoint[0]
+                self.allocator.set_state(json.loads(allocator))
+                print(f'Resuming after row {last_row}')
+                return last_row + 1
+        return start
+
+    def update_checkpoint(self, last_row):
+        """ Store the progress, committed along with the rows.
+        """
+        if self.checkpoint is not None:
+            # The index from a DataFrame may be a numpy integer
+            save_checkpoint(self.pg, self.cohort_id, *self.checkpoint, int(last_row),
+                json.dumps(self.allocator.get_state()))
+
+    def flush_records(self, copy_loader=None, insert_statements=None, bulk_range=50):
+        """ Insert all the pending records, following the references between them.
+        """
+        self.flush_persons()
+        self.flush_person_updates()
+        self.flush_visits()
+        if insert_statements:
+            self.insert_bulk(insert_statements, bulk_range)
+        if copy_loader:
+            copy_loader.flush()
+        self.flush_row_hashes()
+
+    def transform_rows(self, iterator, start, limit, bulk=False, bulk_range=50, copy=False,
+        copy_buffer_size=COPY_BUFFER_DEFAULT_SIZE, commit_every=None):
+        """ Transform each row in the dataset. If commit_every is provided, the rows
+            are inserted in transactions with that number of rows.
         """
-        id_map = {}
         processed_records = 0
         skipped_records = 0
+        unchanged_records = 0
         bulk_insert_records = 0
         id_source_variable = self.get_source_variable(SOURCE_ID)
         if not id_source_variable:
@@ -429,225 +964,273 @@ class DataParser:
             MEASUREMENT: [],
             CONDITION_OCCURRENCE: [],
         }
-        for index, row in iterator:
-            if limit > 0 and index - start >= limit:
-                break
-            try:
-                # Check if the source id variable is provided. In that case,
-                # the link between the source id and the person id will be stored
-                # in a dictionary and in a temporary table.
-                person_id = None
-                # TODO: also provide the source id when there is an error
-                if id_source_variable:
-                    if not self.valid_row_value(id_source_variable, row):
-                        raise ParsingError(
-                            f'Error when parsing the source id ({id_source_variable}) for record number {index}.')
-                    source_id = row[id_source_variable]
-                    if source_id in id_map:
-                        person_id = id_map[source_id]
-                        self.update_person(person_id, row)
-                    else:
-                        # First check if it's already included in the temporary table.
-                        person_id = get_person_id(source_id, self.cohort_id, self.pg)
-                        if person_id:
-                            self.update_person(person_id, row)
-                        else:
-                            person_id = self.parse_person(row)
-                            insert_id_record(source_id, person_id, self.cohort_id, self.pg)
-                        id_map[source_id] = person_id
-                else:
-                    # print('No ID variable available')
-                    person_id = self.parse_person(row)
-                # Parse the row once for each prefix/suffix used
-                visit_found = False
-                fu_info = {
-                    PREFIX: self.fu_prefix,
-                    SUFFIX: self.fu_suffix,
-                }
-                for info_key, info_values in fu_info.items():
-                    for info_value in info_values:
-                        prefix=info_value if info_key == PREFIX else ''
-                        suffix=info_value if info_key == SUFFIX else ''
-                        # Retrieve the visit or insert a new visit for the participant
-                        visits = self.get_visits(
-                            row,
-                            person_id,
-                            prefix=prefix,
-                            suffix=suffix,
-                        )
-                        if len(visits.keys()) > 0:
-                            visit_found = True
-                            # Process the data in the row. If bulk is True, it creates the sql statements by
-                            # OMOP domain. If bulk is False, it will insert each variable individually.
-                            sql_statements = self.transform_row(
-                                row,
-                                person_id,
-                                visits,
-                                prefix=prefix,
-                                suffix=suffix,
-                                bulk=bulk,
-                            )
-                            if bulk:
-                                for (sql_domain, sql_statement) in sql_statements:
-                                    bulk_insert_records += 1
-                                    insert_statements[sql_domain].append(sql_statement)
-                if not visit_found:
-                    print(f'No visit dates found for the person with id {person_id}')
-                # Keep track of the number of records processed
-                processed_records += 1
-                if processed_records % 250 == 0:
-                    print(f'Processed {processed_records} records')
-                if bulk and bulk_insert_records > bulk_range:
-                    # print(f"Bulk insert: {bulk_insert_records} records")
-                    for sql_domain in insert_statements.keys():
-                        # print(f"Domain {sql_domain}")
-                        for record_count in range(0, len(insert_statements[sql_domain]), bulk_range):
-                            self.pg.run_sql(
-                                CDM_SQL_VALUES[sql_domain][BULK](
-                                    insert_statements[sql_domain][record_count: record_count + bulk_range]
+        # When copying, the records are streamed to the database in CSV buffers
+        # instead of building the INSERT statements.
+        copy_loader = None
+        if copy or self.staging:
+            # The staging files are always written as in a COPY
+            copy = True
+            copy_loader = CopyLoader(self.staging or self.pg, copy_buffer_size, before_flush=self.flush_visits)
+        rows = takewhile(lambda item: limit <= 0 or item[0] - start < limit, iterator)
+        for batch in batches(rows, commit_every):
+            with self.pg.transaction() if commit_every and self.pg else nullcontext():
+                for index, row in batch:
+                    try:
+                        person_id = self.get_person(index, row, id_source_variable)
+                        wave_records = self.reshaper.reshape_row(row)
+                        if self.incremental:
+                            wave_records = self.get_changed_records(row, person_id, wave_records, id_source_variable)
+                            if len(wave_records) == 0:
+                                unchanged_records += 1
+                                continue
+                        # Parse the row once for each prefix/suffix used
+                        visit_found = False
+                        for (wave, record) in wave_records:
+                            # Retrieve the visit or insert a new visit for the participant
+                            visits = self.get_visits(record, person_id, wave=wave)
+                            if self.incremental:
+                                self.add_row_hash(wave, visits)
+                            if len(visits.keys()) > 0:
+                                visit_found = True
+                                if not copy and not bulk:
+                                    # The records are inserted right away and reference the visits,
+                                    # which reference the persons. The new persons are only inserted
+                                    # in batches with --copy or --bulk.
+                                    self.flush_visits()
+                                # Process the data in the row. If bulk or copy is True, it creates the records
+                                # to insert in bulk or copy by OMOP domain. Otherwise, it will insert the
+                                # records for the row using a prepared statement.
+                                sql_statements = self.transform_row(
+                                    record,
+                                    person_id,
+                                    visits,
+                                    wave=wave,
+                                    bulk=bulk,
+                                    copy=copy,
                                 )
-                            )
-                        insert_statements[sql_domain] = []
-                    bulk_insert_records = 0
-            except ParsingError as error:
-               # TODO: Use a logger and add this information in a file
-               print(f'Skipped record {index} due to an error: {str(error)}')
-               skipped_records += 1
+                                if copy:
+                                    for (sql_domain, record) in sql_statements:
+                                        copy_loader.add(sql_domain, record)
+                                elif bulk:
+                                    for (sql_domain, sql_statement) in sql_statements:
+                                        bulk_insert_records += 1
+                                        insert_statements[sql_domain].append(sql_statement)
+                        if not visit_found:
+                            print(f'No visit dates found for the person with id {person_id}')
+                        # Keep track of the number of records processed
+                        processed_records += 1
+                        if processed_records % 250 == 0:
+                            print(f'Processed {processed_records} records')
+                        if not copy and bulk and bulk_insert_records > bulk_range:
+                            self.flush_visits()
+                            self.insert_bulk(insert_statements, bulk_range)
+                            bulk_insert_records = 0
+                    except ParsingError as error:
+                       # TODO: Use a logger and add this information in a file
+                       print(f'Skipped record {index} due to an error: {str(error)}')
+                       skipped_records += 1
+                # Everything pending is inserted before committing the rows
+                self.flush_records(copy_loader, insert_statements, bulk_range)
+                bulk_insert_records = 0
+                self.update_checkpoint(index)
+        print(f'Processed {processed_records} records and skipped {skipped_records} records due to errors')
+        if self.incremental:
+            print(f'Skipped {unchanged_records} records without changes')
+
+    def transform_frames(self, frames, start, limit, copy_buffer_size=COPY_BUFFER_DEFAULT_SIZE, commit_every=None,
+        **kwargs):
+        """ Transform the dataset one chunk (DataFrame) at a time. The persons and
+            visits are parsed for each row, the observations/measurements/conditions
+            are transformed for each variable across the chunk and copied to the database.
+            If commit_every is provided, the chunks are committed once they include
+            at least that number of rows.
+        """
+        processed_records = 0
+        skipped_records = 0
+        unchanged_records = 0
+        id_source_variable = self.get_source_variable(SOURCE_ID)
+        if not id_source_variable:
+            print("No source id variable provided!")
+        copy_loader = CopyLoader(self.staging or self.pg, copy_buffer_size, before_flush=self.flush_visits)
+        transformer = FrameTransformer(self)
+        if limit > 0:
+            frames = (frame.loc[:start + limit - 1] for frame in frames)
+        frames = takewhile(lambda frame: len(frame) > 0, frames)
+        for batch in batches(frames, commit_every, count=len):
+            with self.pg.transaction() if commit_every and self.pg else nullcontext():
+                for frame in batch:
+                    wave_frames = dict(self.reshaper.reshape_frame(frame))
+                    person_ids = {}
+                    wave_visits = {wave: {} for wave in self.waves}
+                    for index, row in frame.to_dict('index').items():
+                        try:
+                            person_id = self.get_person(index, row, id_source_variable)
+                            wave_records = self.reshaper.reshape_row(row)
+                            if self.incremental:
+                                wave_records = self.get_changed_records(
+                                    row, person_id, wave_records, id_source_variable)
+                                if len(wave_records) == 0:
+                                    unchanged_records += 1
+                                    continue
+                            visit_found = False
+                            for (wave, record) in wave_records:
+                                visits = self.get_visits(record, person_id, wave=wave)
+                                if self.incremental:
+                                    self.add_row_hash(wave, visits)
+                                if len(visits.keys()) > 0:
+                                    visit_found = True
+                                    wave_visits[wave][index] = visits
+                            if not visit_found:
+                                print(f'No visit dates found for the person with id {person_id}')
+                            person_ids[index] = person_id
+                            processed_records += 1
+                            if processed_records % 250 == 0:
+                                print(f'Processed {processed_records} records')
+                        except ParsingError as error:
+                            print(f'Skipped record {index} due to an error: {str(error)}')
+                            skipped_records += 1
+                    person_ids = pd.Series(person_ids, dtype=object)
+                    for wave in self.waves:
+                        if len(wave_visits[wave]) > 0:
+                            visits = pd.DataFrame.from_dict(wave_visits[wave], orient='index', dtype=object).reindex(
+                                columns=self.date_source_variables)
+                            records = transformer.transform_frame(
+                                wave_frames[wave].loc[visits.index], person_ids, visits, wave)
+                            for domain, domain_records in records.items():
+                                if self.duplicates is not None:
+                                    domain_records = self.duplicates.add_frame(domain, domain_records)
+                                copy_loader.add_frame(domain, domain_records)
+                self.flush_records(copy_loader)
+                self.update_checkpoint(frame.index[-1])
         print(f'Processed {processed_records} records and skipped {skipped_records} records due to errors')
+        if self.incremental:
+            print(f'Skipped {unchanged_records} records without changes')
 
-    def transform_row(self, row, person_id, visits, prefix='', suffix='', bulk=False):
-        """ Transform each row and insert in the database.
+    def transform_row(self, row, person_id, visits, wave=('', ''), bulk=False, copy=False):
+        """ Transform each row and insert in the database. When copying or inserting
+            in bulk, the records are returned instead.
         """
         # Parse the observations/measurements/conditions
         sql_statements = []
-        for key, value in self.source_mapping.items():
-            if key not in self.destination_mapping:
-                if DATE not in key.lower() and key not in self.warnings:
-                    print(f'Skipped variable {key} since its not mapped')
-                    self.warnings.append(key)
-            elif self.destination_mapping[key][DOMAIN] not in CDM_SQL:
-                if self.destination_mapping[key][DOMAIN] not in [PERSON, NOT_APPLICABLE] and \
-                    key not in self.warnings:
-                    print(f'Skipped variable {key} since its domain is not currently accepted')
-                    self.warnings.append(key)
-            else:
-                # TODO: Improve the logic for the Condition column
-                source_value = []
-                source_variable_valid = []
-                source_value_alternative = []
-                source_variable_valid_alternative = []
-                if value[SOURCE_VARIABLE]:
-                    source_variables = [value[SOURCE_VARIABLE]]
-                    if value[ALTERNATIVES]:
-                        source_variables.extend(value[ALTERNATIVES].split(DEFAULT_SEPARATOR))
-                    # Check the first variable for the field that it's valid
-                    for source_variable in source_variables:
-                        source_variable_suffixed = prefix + source_variable + suffix
-                        # Validate source value by checking if it's not null, not a missing value, 
-                        # and (if provided) apply a condition.
-                        if self.valid_row_value(
-                            source_variable_suffixed,
-                            row,
-                            ignore_values=self.missing_values,
-                            validation=self.destination_mapping[key][VALUES_RANGE],
-                            limit=value[LIMIT]
-                        ):
-                            if not is_value_valid(value[CONDITION]) or row[source_variable_suffixed] \
-                                in value[CONDITION].split(DEFAULT_SEPARATOR):
-                                    source_value.append(row[source_variable_suffixed])
-                                    source_variable_valid.append(source_variable_suffixed)
-                            else:
-                                source_value_alternative.append(row[source_variable_suffixed])
-                                source_variable_valid_alternative.append(source_variable_suffixed)
-                    if len(source_value) == 0:
-                        source_value = source_value_alternative
-                        source_variable_valid = source_variable_valid_alternative
-                # TODO: Also used for additonal information added to a different column
-                # probably better to separate the two.
-                elif value[STATIC_VALUE]:
-                    source_value = [value[STATIC_VALUE]]
-                if len(source_value) > 0:
-                    # TODO: improve the mapping between a variable and multiple
-                    # source variables
-                    try:
-                        domain = self.destination_mapping[key][DOMAIN]
-                        (value_as_concept, parsed_value, symbol_cid) = self.get_parsed_value(
-                            key,
-                            source_value if value[AGGREGATE] else source_value[0],
-                            aggregate=value[AGGREGATE],
-                            conversion=value[CONVERSION],
-                            threshold=value[THRESHOLD],
-                            source_variable=source_variable_valid[0] if len(source_variable_valid) > 0 else None,
-                            format=value[FORMAT],
-                            type=self.destination_mapping[key][TYPE],
-                            prefix=prefix,
-                            suffix=suffix,
-                        )
-                        if parsed_value != DEFAULT_SKIP:
-                            # Check if there is a specific date for the variable
-                            date = DATE_DEFAULT
-                            visit_id = visits[list(visits.keys())[0]]
-                            (source_dates, source_date_format, _) = self.get_parameters(
-                                self.destination_mapping[key][DATE])
-                            if source_dates:
-                                for source_date in source_dates:
-                                    source_date_variable = prefix + source_date + suffix
-                                    if source_date_variable in visits:
-                                        visit_id = visits[source_date_variable]
-                                    if self.valid_row_value(source_date_variable, row, ignore_values=self.missing_values):
-                                        try:
-                                            date = parse_date(
-                                                str(row[source_date_variable]),
-                                                source_date_format or self.date_format,
-                                                DATE_FORMAT,
-                                            )
-                                            break
-                                        except Exception as error:
-                                            raise ParsingError(
-                                                f'Error parsing a malformated date for variable {key} \
-                                                    with source variable {source_date_variable}: {str(error)})'
-                                            )
-                            # Create the necessary arguments to build the SQL statement
-                            named_args = {
-                                'source_value': self.parse_source_value(source_value),
-                                'date': date,
-                                'visit_id': visit_id,
-                                'symbol_cid': symbol_cid
-                            }
-                            if value_as_concept:
-                                named_args['value_as_concept'] = parsed_value
-                            else:
-                                named_args['value'] = parsed_value
-                            # Check if there is a field for additional information
-                            additional_info = self.destination_mapping[key][ADDITIONAL_INFO]
-                            if additional_info and additional_info in self.source_mapping:
-                                additional_info_value = self.source_mapping[additional_info][STATIC_VALUE]
-                                if additional_info_value:
-                                    named_args['additional_info'] = additional_info_value
-                                else:
-                                    additional_info_variable = prefix + self.source_mapping[additional_info][SOURCE_VARIABLE] + suffix
-                                    if additional_info_variable and self.valid_row_value(additional_info_variable, row):
-                                        additional_info_value = self.get_parsed_value(
-                                            additional_info_variable,
-                                            row[additional_info_variable],
-                                            source_variable=additional_info_variable
-                                        )[1]
-                                        named_args['additional_info'] = f'{additional_info_variable}: {additional_info_value}'
-                            elif value[STATIC_VALUE]:
-                                named_args['additional_info'] = value[STATIC_VALUE]
-
-                            # Run the SQL script to insert the measurement/observation/condition
-                            # if not self.ignore_duplicate or not self.pg.run_sql(
-                            #     *CDM_SQL[domain][CHECK_DUPLICATE](person_id, self.destination_mapping[key], **named_args),
-                            #     fetch_one=True
-                            # ):
-                            if bulk:
-                                sql_statements.append((domain, CDM_SQL_VALUES[domain][BUILD](person_id, self.destination_mapping[key], **named_args)))
-                            else:
-                                self.pg.run_sql(*CDM_SQL[domain][BUILD](person_id, self.destination_mapping[key], **named_args))
-                    except ParsingError as error:
-                        if key not in self.warnings:
-                            self.warnings.append(key)
-                            print(f"Error when transforming the row for variable {key}: {error}")
-                        pass
+        for plan in self.plans:
+            named_args = self.execute_plan(plan, row, visits, wave)
+            if named_args is not None:
+                record_id = self.allocator.next_id(CDM_TABLES[plan.domain][SEQUENCE])
+                record = plan.build_record(record_id, person_id, plan.field, **named_args)
+                if self.duplicates is None or self.duplicates.add(plan.domain, record):
+                    sql_statements.append((plan.domain, record))
+        if not copy and not bulk:
+            # Insert the records for the row with the prepared statement for each domain
+            insert_records(sql_statements, self.pg)
+            return []
         return sql_statements
+
+    def execute_plan(self, plan, record, visits, wave=('', '')):
+        """ Execute the plan for a variable in the record for a wave. Returns the arguments
+            to build the observation/measurement/condition or None if there is no value.
+        """
+        (prefix, suffix) = wave
+        # TODO: Improve the logic for the Condition column
+        source_value = []
+        source_variable_valid = []
+        source_value_alternative = []
+        source_variable_valid_alternative = []
+        if plan.source_variables:
+            # Check the first variable for the field that it's valid
+            for source_variable in plan.source_variables:
+                # Validate source value by checking if it's not null, not a missing value, 
+                # and (if provided) apply a condition.
+                if self.valid_row_value(
+                    source_variable,
+                    record,
+                    ignore_values=self.missing_values,
+                    validation=plan.validation,
+                    limit=plan.limit
+                ):
+                    if plan.condition is None or record[source_variable] in plan.condition:
+                        source_value.append(record[source_variable])
+                        source_variable_valid.append(source_variable)
+                    else:
+                        source_value_alternative.append(record[source_variable])
+                        source_variable_valid_alternative.append(source_variable)
+            if len(source_value) == 0:
+                source_value = source_value_alternative
+                source_variable_valid = source_variable_valid_alternative
+        # TODO: Also used for additonal information added to a different column
+        # probably better to separate the two.
+        elif plan.static_value:
+            source_value = [plan.static_value]
+        if len(source_value) == 0:
+            return None
+        # TODO: improve the mapping between a variable and multiple
+        # source variables
+        try:
+            (value_as_concept, parsed_value, symbol_cid) = self.get_parsed_value(
+                plan.variable,
+                source_value if plan.aggregate else source_value[0],
+                aggregate=plan.aggregate,
+                conversion=plan.conversion,
+                threshold=plan.threshold,
+                source_variable=self.reshaper.get_column(wave, source_variable_valid[0]) \
+                    if len(source_variable_valid) > 0 else None,
+                format=plan.format,
+                type=plan.type,
+                prefix=prefix,
+                suffix=suffix,
+            )
+            if parsed_value == DEFAULT_SKIP:
+                return None
+            # Check if there is a specific date for the variable
+            date = DATE_DEFAULT
+            visit_id = visits[list(visits.keys())[0]]
+            if plan.date_variables:
+                for source_date_variable in plan.date_variables:
+                    if source_date_variable in visits:
+                        visit_id = visits[source_date_variable]
+                    if self.valid_row_value(source_date_variable, record, ignore_values=self.missing_values):
+                        try:
+                            date = parse_date(
+                                str(record[source_date_variable]),
+                                plan.date_format,
+                                DATE_FORMAT,
+                            )
+                            break
+                        except Exception as error:
+                            date_variable = self.reshaper.get_column(wave, source_date_variable)
+                            raise ParsingError(
+                                f'Error parsing a malformated date for variable {plan.variable} \
+                                    with source variable {date_variable}: {str(error)})'
+                            )
+            # Create the necessary arguments to build the SQL statement
+            named_args = {
+                'source_value': self.parse_source_value(source_value),
+                'date': date,
+                'visit_id': visit_id,
+                'symbol_cid': symbol_cid
+            }
+            if value_as_concept:
+                named_args['value_as_concept'] = parsed_value
+            else:
+                named_args['value'] = parsed_value
+            # Check if there is a field for additional information
+            if plan.additional_info_static:
+                named_args['additional_info'] = plan.additional_info_static
+            elif plan.additional_info_variable and self.valid_row_value(plan.additional_info_variable, record):
+                additional_info_variable = self.reshaper.get_column(wave, plan.additional_info_variable)
+                additional_info_value = self.get_parsed_value(
+                    additional_info_variable,
+                    record[plan.additional_info_variable],
+                    source_variable=additional_info_variable
+                )[1]
+                named_args['additional_info'] = f'{additional_info_variable}: {additional_info_value}'
+            return named_args
+        except ParsingError as error:
+            self.warn_variable(plan.variable, error)
+        return None
+
+    def warn_variable(self, variable, error):
+        """ Report an error when transforming a variable (only once for each variable).
+        """
+        if variable not in self.warnings:
+            self.warnings.append(variable)
+            print(f"Error when transforming the row for variable {variable}: {error}")
@@ -0,0 +1,104 @@
+import io
+import queue
+import threading
+from contextlib import contextmanager
+
+from constants import *
+
+class PipelinedWriter:
+    """ Runs the statements writing to the database in a separate thread, so that
+        the dataset is transformed while waiting for the database. The statements
+        are kept in a bounded queue and run in order, the statements returning
+        results wait for the queue to be empty. Provides the methods of the
+        PostgresManager used when parsing the dataset.
+    """
+    def __init__(self, pg, queue_size=PIPELINE_QUEUE_DEFAULT_SIZE):
+        self.pg = pg
+        self.statements = queue.Queue(maxsize=int(queue_size))
+        self.error = None
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.statements.put(None)
+        self.thread.join()
+        if exc_type is None:
+            self.check()
+
+    def run(self):
+        """ Run the statements in the queue until receiving None. After an error,
+            the remaining statements are skipped.
+        """
+        while True:
+            statement = self.statements.get()
+            try:
+                if statement is None:
+                    return
+                if self.error is None:
+                    (function, args, kwargs) = statement
+                    function(*args, **kwargs)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.statements.task_done()
+
+    def check(self):
+        """ Raise the error from the statements run in the queue, if any.
+        """
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def submit(self, function, *args, **kwargs):
+        """ Add a statement to the queue, waiting if the queue is full.
+        """
+        self.check()
+        self.statements.put((function, args, kwargs))
+
+    def wait(self):
+        """ Wait until all the statements in the queue were run.
+        """
+        self.statements.join()
+        self.check()
+
+    @contextmanager
+    def transaction(self):
+        """ Run the statements in a single transaction, committed once all the
+            statements in the queue were run.
+        """
+        self.wait()
+        with self.pg.transaction():
+            try:
+                yield self
+            finally:
+                # Commit or rollback only after the pending statements
+                self.statements.join()
+            self.check()
+
+    def run_sql(self, statement, parameters=None, fetch_one=False, fetch_all=False):
+        if fetch_one or fetch_all:
+            self.wait()
+            return self.pg.run_sql(statement, parameters, fetch_one=fetch_one, fetch_all=fetch_all)
+        self.submit(self.pg.run_sql, statement, parameters)
+
+    def execute_values(self, statement, values, template=None, page_size=1000):
+        self.submit(self.pg.execute_values, statement, list(values), template=template, page_size=page_size)
+
+    def prepare(self, name, statement):
+        self.submit(self.pg.prepare, name, statement)
+
+    def execute_prepared(self, name, values, page_size=100):
+        self.submit(self.pg.execute_prepared, name, list(values), page_size=page_size)
+
+    def execute_prepared_many(self, statements, page_size=100):
+        self.submit(self.pg.execute_prepared_many, [(name, list(values)) for (name, values) in statements],
+            page_size=page_size)
+
+    def copy_from_buffer(self, table, columns, buffer):
+        # The buffer is reused once the records are added to the queue
+        self.submit(self.pg.copy_from_buffer, table, columns, io.StringIO(buffer.read()))
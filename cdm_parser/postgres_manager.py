@@ -1,7 +1,8 @@
 import psycopg2
 import os
-from psycopg2 import Error
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from contextlib import contextmanager
+from psycopg2 import Error, extras, pool
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, ISOLATION_LEVEL_DEFAULT
 from constants import *
 
 class PostgresManager:
@@ -20,29 +21,65 @@ class PostgresManager:
             '' if default_db else os.getenv(DB_DATABASE)
         )
 
-    def __init__(self, default_db=False, isolation_level=None):
+    @staticmethod
+    def get_connection_options(settings=None):
+        """ Build the options to apply the session settings once for each
+            connection. The settings are provided as "name=value" separated
+            by ";" (by default, from the DB_SETTINGS configuration).
+        """
+        settings = settings if settings is not None else os.getenv(DB_SETTINGS)
+        options = []
+        for setting in (settings or '').split(DEFAULT_SEPARATOR):
+            if setting.strip():
+                (name, value) = setting.split('=', 1)
+                # The spaces in the values are escaped
+                value = value.strip().replace(' ', '\\ ')
+                options.append(f'-c {name.strip()}={value}')
+        return ' '.join(options) or None
+
+    def __init__(self, default_db=False, isolation_level=None, pool=None, settings=None):
         self.default_db = default_db
         self.isConnected = False
         self.isolation_level = isolation_level
+        # When a pool is provided, the connection is taken from the pool and
+        # returned when exiting (the settings are applied by the pool)
+        self.pool = pool
+        self.settings = settings
+        # Number of nested transactions open, the statements are only
+        # committed when no transaction is open
+        self.transaction_level = 0
     
     def __enter__(self):
         """ Sets up the connection to the postgres database.
         """
-        self.connection = psycopg2.connect(
-            self.get_database_uri(default_db=self.default_db))
+        if self.pool is not None:
+            self.connection = self.pool.getconn()
+        else:
+            self.connection = psycopg2.connect(
+                self.get_database_uri(default_db=self.default_db),
+                options=self.get_connection_options(self.settings))
         if self.connection:
             if self.isolation_level is not None:
                 self.connection.set_isolation_level(self.isolation_level)
             self.cursor = self.connection.cursor()
             self.isConnected = True
+            # Statements prepared for the connection
+            self.prepared_statements = self.pool.get_prepared_statements(self.connection) \
+                if self.pool is not None else set()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """ Wraps up the connection and other settings when exiting.
         """
         if self.isConnected:
-            self.connection.close()
             self.cursor.close()
+            if self.pool is not None:
+                if self.isolation_level is not None:
+                    self.connection.set_isolation_level(ISOLATION_LEVEL_DEFAULT)
+                self.pool.putconn(self.connection)
+            else:
+                self.connection.close()
+            self.isConnected = False
 
     def create_database(self, database_name):
         """ Create a new database.
@@ -75,9 +112,32 @@ class PostgresManager:
         """
         self.run_sql(f'DROP TABLE IF EXISTS {table};')
 
+    def commit(self):
+        """ Commit the changes, unless they're part of a transaction.
+        """
+        if self.transaction_level == 0:
+            self.connection.commit()
+
+    @contextmanager
+    def transaction(self):
+        """ Run the statements in a single transaction, committed when leaving
+            the context (or rolled back in case of an error). Nested transactions
+            are part of the outermost one.
+        """
+        self.transaction_level += 1
+        try:
+            yield self
+        except Exception:
+            self.transaction_level -= 1
+            if self.transaction_level == 0:
+                self.connection.rollback()
+            raise
+        self.transaction_level -= 1
+        self.commit()
+
     def run_sql(self, statement, parameters=None, fetch_one=False, fetch_all=False):
         self.cursor.execute(statement, parameters)
-        self.connection.commit()
+        self.commit()
 
         if fetch_one:
             result = self.cursor.fetchone()
@@ -85,15 +145,115 @@ class PostgresManager:
         elif fetch_all:
             return self.cursor.fetchall()
 
+    def stream(self, statement, parameters=None, itersize=STREAM_DEFAULT_ITERSIZE, name='stream'):
+        """ Run a query with a named (server-side) cursor, fetching the rows in
+            batches of itersize as they're read. The cursor is closed once all
+            the rows are read, nothing should be committed in the connection
+            before that.
+        """
+        cursor = self.connection.cursor(name=name)
+        cursor.itersize = int(itersize)
+        try:
+            cursor.execute(statement, parameters)
+            yield from cursor
+        finally:
+            cursor.close()
+            self.commit()
+
+    def execute_values(self, statement, values, template=None, page_size=1000):
+        """ Run a statement for multiple rows, the values are provided
+            in a single VALUES %s placeholder.
+        """
+        extras.execute_values(self.cursor, statement, values, template=template, page_size=page_size)
+        self.commit()
+
+    def prepare(self, name, statement):
+        """ Prepare a statement (with the parameters $1, $2, ...) once
+            for the connection.
+        """
+        if name not in self.prepared_statements:
+            self.cursor.execute(f'PREPARE {name} AS {statement}')
+            self.prepared_statements.add(name)
+
+    def execute_prepared(self, name, values, page_size=100):
+        """ Execute a prepared statement for multiple rows, sending the
+            statements to the server in pages.
+        """
+        self.execute_prepared_many([(name, values)], page_size=page_size)
+
+    def execute_prepared_many(self, statements, page_size=100):
+        """ Execute multiple prepared statements (the name and the rows for
+            each one), committed together.
+        """
+        statements = [(name, values) for (name, values) in statements if values]
+        for (name, values) in statements:
+            parameters = ','.join(['%s'] * len(values[0]))
+            extras.execute_batch(self.cursor, f'EXECUTE {name} ({parameters})', values, page_size=page_size)
+        if statements:
+            self.commit()
+
     def execute_file(self, path):
         """ Execute a file with a sql script.
         """
         self.cursor.execute(open(path, 'r').read())
-        self.connection.commit()
+        self.commit()
+
+    def copy_expert(self, statement, data):
+        """ Run a COPY statement reading the data from a file-like object.
+        """
+        self.cursor.copy_expert(statement, data)
+        self.commit()
 
     def copy_from_file(self, table, path):
         """ Insert data from a file.
         """
         with open(path, 'r') as data:
-            self.cursor.copy_expert(f"COPY {table} FROM STDOUT WITH DELIMITER E'\t' NULL '' CSV HEADER QUOTE E'\b' ;", data)
-            self.connection.commit()
+            self.copy_expert(f"COPY {table} FROM STDOUT WITH DELIMITER E'\t' NULL '' CSV HEADER QUOTE E'\b' ;", data)
+
+    def copy_from_buffer(self, table, columns, buffer):
+        """ Insert data from an in-memory CSV buffer.
+        """
+        self.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}');", buffer)
+
+class PostgresPool:
+    """ Keeps the connections to the database to be shared by multiple
+        PostgresManager (e.g. one for each thread), the connections are opened
+        at once and reused until the pool is closed. The session settings are
+        applied once for each connection.
+    """
+    def __init__(self, connections=POOL_DEFAULT_SIZE, default_db=False, settings=None):
+        self.pool = pool.ThreadedConnectionPool(
+            connections,
+            connections,
+            PostgresManager.get_database_uri(default_db=default_db),
+            options=PostgresManager.get_connection_options(settings),
+        )
+        # Statements prepared for each connection
+        self.prepared_statements = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.pool.closeall()
+
+    def getconn(self):
+        """ Take a connection from the pool.
+        """
+        return self.pool.getconn()
+
+    def putconn(self, connection):
+        """ Return a connection to the pool (rolling back what wasn't committed).
+        """
+        self.pool.putconn(connection)
+
+    def get_prepared_statements(self, connection):
+        """ Retrieve the statements prepared for a connection from the pool.
+        """
+        return self.prepared_statements.setdefault(id(connection), set())
+
+    def manager(self, isolation_level=None):
+        """ Build a PostgresManager using a connection from the pool.
+        """
+        return PostgresManager(isolation_level=isolation_level, pool=self)
@@ -0,0 +1,96 @@
+import codecs
+import csv
+import json
+import locale
+import os
+
+from constants import *
+
+def get_index_path(path):
+    """ Retrieve the path for the row index of a csv file.
+    """
+    return path + ROW_INDEX_EXTENSION
+
+def get_file_fingerprint(path, delimiter, encoding):
+    """ Retrieve the information used to check if the index is still valid
+        for the csv file.
+    """
+    status = os.stat(path)
+    return {
+        'size': status.st_size,
+        'mtime': status.st_mtime_ns,
+        'delimiter': delimiter,
+        'encoding': encoding,
+        'step': ROW_INDEX_STEP,
+    }
+
+def read_lines(binary_file, decoder, position):
+    """ Read the lines from a file, keeping the position (in bytes) after
+        the last line read.
+    """
+    for line in binary_file:
+        position[0] += len(line)
+        yield decoder.decode(line)
+
+def build_row_index(path, delimiter, encoding=None, errors='strict'):
+    """ Build the index with the position (in bytes) of the rows in a csv file,
+        one position for each ROW_INDEX_STEP rows. The rows are counted as done
+        when reading the dataset (the empty lines are skipped and a quoted field
+        can include multiple lines).
+    """
+    decoder = codecs.getincrementaldecoder(encoding or locale.getpreferredencoding(False))(errors)
+    offsets = []
+    with open(path, 'rb') as binary_file:
+        position = [0]
+        csv_reader = csv.reader(read_lines(binary_file, decoder, position), delimiter=delimiter)
+        # The header isn't included in the index
+        next(csv_reader, None)
+        rows = 0
+        start = position[0]
+        for values in csv_reader:
+            if values:
+                if rows % ROW_INDEX_STEP == 0:
+                    offsets.append(start)
+                rows += 1
+            start = position[0]
+    return offsets
+
+def load_row_index(path, delimiter, encoding=None, errors='strict'):
+    """ Load the index for a csv file, building it (and storing it next to the
+        file) if it doesn't exist or the file was modified.
+    """
+    fingerprint = get_file_fingerprint(path, delimiter, encoding)
+    index_path = get_index_path(path)
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'r') as index_file:
+                index = json.load(index_file)
+            if index.get('fingerprint') == fingerprint:
+                return index['offsets']
+        except (OSError, ValueError) as error:
+            print(f'Error reading the row index {index_path}: {str(error)}')
+    print(f'Building the row index for {path}')
+    offsets = build_row_index(path, delimiter, encoding, errors)
+    try:
+        with open(index_path, 'w') as index_file:
+            json.dump({'fingerprint': fingerprint, 'offsets': offsets}, index_file)
+    except OSError as error:
+        print(f'Error storing the row index {index_path}: {str(error)}')
+    return offsets
+
+def get_row_offset(path, row, delimiter, encoding=None, errors='strict'):
+    """ Retrieve the position (in bytes) of the closest indexed row before the
+        row provided. Returns the position (None to read from the start) and the
+        number of rows to skip from there.
+    """
+    if row <= 0:
+        return (None, 0)
+    try:
+        offsets = load_row_index(path, delimiter, encoding, errors)
+    except (csv.Error, UnicodeError) as error:
+        print(f'Error building the row index for {path}: {str(error)}')
+        return (None, row)
+    if not offsets:
+        return (None, row)
+    block = min(row // ROW_INDEX_STEP, len(offsets) - 1)
+    return (offsets[block], row - block * ROW_INDEX_STEP)
@@ -0,0 +1,173 @@
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+
+from cdm_builder import *
+from constants import *
+from utils import batches
+
+# Columns for the files written in the output directory, in the order the
+# tables are loaded (the persons and visits before the records referencing them)
+STAGING_TABLES = {
+    'PERSON': PERSON_COLUMNS,
+    ID_TABLE: ID_TABLE_COLUMNS,
+    'VISIT_OCCURRENCE': VISIT_OCCURRENCE_COLUMNS,
+    **{table[TABLE]: table[COLUMNS] for table in CDM_TABLES.values()},
+    PERSON_UPDATE_STAGING: ('person_id', 'death_datetime'),
+}
+
+# Sequence for the ids assigned locally in each column
+STAGING_ID_COLUMNS = {
+    'person_id': PERSON_SEQUENCE,
+    'visit_occurrence_id': VISIT_OCCURRENCE,
+    **{table[ID_COLUMN]: table[SEQUENCE] for table in CDM_TABLES.values()},
+}
+
+# Columns with the cohort id, only known when loading the files
+STAGING_COHORT_COLUMNS = ('care_site_id', 'cohort_id')
+
+def get_staging_path(directory, table):
+    """ Retrieve the path for the file with a table in the output directory.
+    """
+    return os.path.join(directory, table.lower() + STAGING_EXTENSION)
+
+class StagingWriter:
+    """ Writes the CDM tables to compressed csv files (one for each table) instead
+        of inserting them in the database, the files are loaded later with
+        load_staging. The ids are assigned locally and the manifest keeps the
+        last id used for each sequence. Provides the same copy_from_buffer as
+        the PostgresManager, used by the CopyLoader.
+    """
+    def __init__(self, output_dir, cohort_name=None, cohort_location=None):
+        self.output_dir = output_dir
+        self.cohort_name = cohort_name
+        self.cohort_location = cohort_location
+        self.files = {}
+        self.writers = {}
+
+    def __enter__(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_file(self, table, columns):
+        """ Retrieve the file for a table, creating it with the header if needed.
+        """
+        if table not in self.files:
+            self.files[table] = gzip.open(get_staging_path(self.output_dir, table), 'wt', newline='',
+                compresslevel=STAGING_COMPRESSION_LEVEL)
+            self.writers[table] = csv.writer(self.files[table], lineterminator='\n')
+            self.writers[table].writerow(columns)
+        return self.files[table]
+
+    def write_records(self, table, columns, records):
+        """ Write multiple records (following the columns provided) for a table.
+        """
+        self.get_file(table, columns)
+        self.writers[table].writerows(
+            [COPY_NULL if value is None else value for value in record] for record in records)
+
+    def copy_from_buffer(self, table, columns, buffer):
+        """ Write the records in an in-memory CSV buffer for a table.
+        """
+        shutil.copyfileobj(buffer, self.get_file(table, columns))
+
+    def write_manifest(self, last_ids):
+        """ Write the information needed to load the files (cohort and the last
+            id used for each sequence).
+        """
+        with open(os.path.join(self.output_dir, STAGING_MANIFEST), 'w') as manifest_file:
+            json.dump({
+                'cohort_name': self.cohort_name,
+                'cohort_location': self.cohort_location,
+                'last_ids': last_ids,
+            }, manifest_file, indent=2)
+
+    def close(self):
+        """ Close the files written.
+        """
+        for staging_file in self.files.values():
+            staging_file.close()
+        self.files = {}
+        self.writers = {}
+
+def shift_rows(reader, columns, offsets, cohort_id):
+    """ Move the ids assigned locally to the blocks reserved in the database
+        and set the cohort id for each row.
+    """
+    id_positions = [(position, offsets.get(STAGING_ID_COLUMNS[column], 0))
+        for position, column in enumerate(columns) if column in STAGING_ID_COLUMNS]
+    cohort_positions = [position for position, column in enumerate(columns) if column in STAGING_COHORT_COLUMNS]
+    for row in reader:
+        for (position, offset) in id_positions:
+            if row[position] != COPY_NULL:
+                row[position] = int(row[position]) + offset
+        if cohort_id is not None:
+            for position in cohort_positions:
+                row[position] = cohort_id
+        yield row
+
+def load_staging_table(pg, path, table, offsets, cohort_id, buffer_size=COPY_BUFFER_DEFAULT_SIZE):
+    """ Copy the records from a file in the output directory to a table.
+        Returns the number of records.
+    """
+    records = 0
+    with gzip.open(path, 'rt', newline='') as staging_file:
+        reader = csv.reader(staging_file)
+        columns = next(reader)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        for row in shift_rows(reader, columns, offsets, cohort_id):
+            writer.writerow(row)
+            records += 1
+            if buffer.tell() >= buffer_size:
+                buffer.seek(0)
+                pg.copy_from_buffer(table, columns, buffer)
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell() > 0:
+            buffer.seek(0)
+            pg.copy_from_buffer(table, columns, buffer)
+    return records
+
+def load_person_updates(pg, path, offsets):
+    """ Update the death datetime for the persons from the file in the output directory.
+    """
+    with gzip.open(path, 'rt', newline='') as staging_file:
+        reader = csv.reader(staging_file)
+        columns = next(reader)
+        for batch in batches(shift_rows(reader, columns, offsets, None), ID_RECORDS_BATCH_SIZE):
+            update_persons([tuple(row) for row in batch], pg)
+
+def load_staging(pg, input_dir, buffer_size=COPY_BUFFER_DEFAULT_SIZE):
+    """ Load the files written by the StagingWriter. The cohort is inserted
+        (or retrieved) and a block of ids is reserved from each sequence, the
+        files are then copied in a single transaction.
+    """
+    with open(os.path.join(input_dir, STAGING_MANIFEST), 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    cohort_id = None
+    if manifest.get('cohort_name'):
+        location_id = insert_location(manifest.get('cohort_location') or manifest['cohort_name'], pg)
+        cohort_id = insert_cohort(manifest['cohort_name'], location_id, pg)
+        print(f"Cohort id {str(cohort_id)}")
+    create_id_table(pg)
+    offsets = {}
+    for sequence, last_id in manifest['last_ids'].items():
+        if last_id > 0:
+            offsets[sequence] = reserve_ids(pg, sequence, last_id) - last_id
+    with pg.transaction():
+        for table in STAGING_TABLES.keys():
+            path = get_staging_path(input_dir, table)
+            if not os.path.exists(path):
+                continue
+            if table == PERSON_UPDATE_STAGING:
+                load_person_updates(pg, path, offsets)
+            else:
+                records = load_staging_table(pg, path, table, offsets, cohort_id, buffer_size)
+                print(f'Loaded {records} records into the {table} table')
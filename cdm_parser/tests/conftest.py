@@ -0,0 +1,195 @@
+import collections
+import csv
+import io
+import os
+import re
+import shutil
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+from psycopg2.extensions import adapt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cdm_builder import CDM_TABLES
+from constants import *
+from parser import parse_csv_mapping
+from parse_dataset import DataParser
+
+EXAMPLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'examples')
+FOLLOW_UP_SUFFIX = '_FU1'
+COHORT_ID = 1
+
+class DuplicateKeyError(Exception):
+    """ Raised (as done by Postgres) when an upsert includes the same key twice.
+    """
+
+class FakeDatabase:
+    """ Keeps in memory the tables written by the DataParser, answering the
+        statements it sends to the database.
+    """
+    def __init__(self):
+        self.sequences = collections.Counter()
+        self.persons = {}
+        self.source_ids = {}
+        self.id_cohorts = {}
+        self.cohorts = {}
+        self.visits = {}
+        self.records = {domain[TABLE]: {} for domain in CDM_TABLES.values()}
+        self.row_hashes = {}
+        self.checkpoints = {}
+        self.transaction_level = 0
+        # The tables for each commit outside a transaction
+        self.autocommits = []
+
+    @contextmanager
+    def transaction(self):
+        self.transaction_level += 1
+        try:
+            yield self
+        finally:
+            self.transaction_level -= 1
+
+    def run_sql(self, statement, parameters=None, fetch_one=False, fetch_all=False):
+        # The parameters must be supported by psycopg2 (e.g. not numpy types)
+        for parameter in parameters or ():
+            adapt(parameter)
+        statement = ' '.join(statement.split())
+        if 'setval' in statement:
+            (sequence, size) = re.search(r"setval\('(\w+)', nextval\('\w+'\) \+ (\d+)\)", statement).groups()
+            self.sequences[sequence] += int(size) + 1
+            return self.sequences[sequence]
+        if 'INTO LOCATION' in statement:
+            self.sequences[LOCATION_SEQUENCE] += 1
+            return self.sequences[LOCATION_SEQUENCE]
+        if 'INTO CARE_SITE' in statement:
+            # The ids follow the cohort used by build_parser
+            name = re.search(r"care_site_name='([^']*)'", statement).group(1)
+            return self.cohorts.setdefault(name, COHORT_ID + len(self.cohorts) + 1)
+        if f'FROM {ID_TABLE}' in statement:
+            return [(source_id, person_id, None) for person_id, source_id in self.source_ids.items()]
+        if statement.startswith('SELECT person_id, visit_start_datetime'):
+            # A comparison with NULL only matches with IS NOT DISTINCT FROM
+            return [(visit['person_id'], datetime.strptime(visit['start_date'], DATE_FORMAT), visit_id)
+                for visit_id, visit in self.visits.items() if visit['cohort_id'] == parameters[0]
+                    and (visit['cohort_id'] is not None or 'IS NOT DISTINCT FROM' in statement)]
+        if f'FROM {ROW_HASH_TABLE}' in statement:
+            return [(source_id, prefix, suffix, row_hash, visit_ids)
+                for (source_id, prefix, suffix), (row_hash, visit_ids) in self.row_hashes.items()]
+        if f'FROM {CHECKPOINT_TABLE}' in statement:
+            checkpoint = self.checkpoints.get(parameters)
+            return [checkpoint] if checkpoint else []
+        if f'INTO {CHECKPOINT_TABLE}' in statement:
+            self.checkpoints[parameters[:3]] = parameters[3:]
+        elif statement.startswith('DELETE FROM VISIT_OCCURRENCE'):
+            for visit_id in parameters[0]:
+                del self.visits[visit_id]
+        elif statement.startswith('DELETE FROM'):
+            table = statement.split()[2]
+            position = [domain for domain in CDM_TABLES.values() if domain[TABLE] == table][0][COLUMNS].index(
+                'visit_occurrence_id')
+            for record_id, record in list(self.records[table].items()):
+                if int(record[1]) in parameters[0] and int(record[position]) in parameters[1]:
+                    del self.records[table][record_id]
+
+    def execute_values(self, statement, values, template=None, page_size=1000):
+        statement = ' '.join(statement.split())
+        if statement.startswith('INSERT INTO PERSON'):
+            for person in values:
+                self.persons[person['person_id']] = dict(person)
+        elif statement.startswith('UPDATE PERSON'):
+            for (person_id, death_datetime) in values:
+                self.persons[person_id]['death_datetime'] = death_datetime
+        elif ID_TABLE in statement:
+            for (person_id, source_id, cohort_id) in values:
+                self.source_ids[person_id] = source_id
+                self.id_cohorts[person_id] = cohort_id
+        elif 'VISIT_OCCURRENCE' in statement:
+            for visit in values:
+                self.visits[visit['visit_id']] = dict(visit)
+        elif ROW_HASH_TABLE in statement:
+            keys = [(source_id, prefix, suffix) for (_, source_id, prefix, suffix, _, _) in values]
+            if len(keys) != len(set(keys)):
+                raise DuplicateKeyError('ON CONFLICT DO UPDATE command cannot affect row a second time')
+            for (_, source_id, prefix, suffix, row_hash, visit_ids) in values:
+                self.row_hashes[(source_id, prefix, suffix)] = (row_hash, visit_ids)
+        else:
+            raise NotImplementedError(statement)
+
+    def prepare(self, name, statement):
+        pass
+
+    def execute_prepared_many(self, statements, page_size=100):
+        for (name, values) in statements:
+            table = name[len('insert_'):].upper()
+            for record in values:
+                self.records[table][int(record[0])] = [str(value) for value in record]
+        if statements and self.transaction_level == 0:
+            self.autocommits.append({name for (name, _) in statements})
+
+    def copy_from_buffer(self, table, columns, buffer):
+        for record in csv.reader(io.StringIO(buffer.read())):
+            # The persons, links, and visits are only copied when loading the staging files
+            values = dict(zip(columns, [None if value == COPY_NULL else value for value in record]))
+            if table == 'PERSON':
+                self.persons[int(values['person_id'])] = {
+                    'person_id': int(values['person_id']),
+                    'gender': values['gender_concept_id'],
+                    'year_of_birth': values['year_of_birth'],
+                    'death_datetime': values['death_datetime'],
+                    'cohort_id': values['care_site_id'],
+                }
+            elif table == ID_TABLE:
+                self.source_ids[int(values['person_id'])] = values['source_id']
+                self.id_cohorts[int(values['person_id'])] = values['cohort_id']
+            elif table == 'VISIT_OCCURRENCE':
+                self.visits[int(values['visit_occurrence_id'])] = {
+                    'visit_id': int(values['visit_occurrence_id']),
+                    'person_id': int(values['person_id']),
+                    'start_date': values['visit_start_date'],
+                    'end_date': values['visit_end_date'],
+                    'cohort_id': values['care_site_id'],
+                }
+            else:
+                self.records[table][int(record[0])] = record
+
+    def get_content(self):
+        """ Retrieve the records, visits, and persons (without the ids assigned).
+        """
+        records = collections.Counter()
+        for domain in CDM_TABLES.values():
+            position = domain[COLUMNS].index('visit_occurrence_id')
+            for record in self.records[domain[TABLE]].values():
+                visit = self.visits[int(record[position])]
+                records[(domain[TABLE], self.source_ids[int(record[1])], visit['start_date'])
+                    + tuple(value for i, value in enumerate(record) if i > 1 and i != position)] += 1
+        visits = collections.Counter(
+            (self.source_ids[visit['person_id']], visit['start_date']) for visit in self.visits.values())
+        persons = collections.Counter(
+            (self.source_ids[person_id], str(person['gender']), str(person['year_of_birth']))
+                for person_id, person in self.persons.items())
+        return (records, visits, persons)
+
+@pytest.fixture
+def mappings():
+    return (
+        parse_csv_mapping(os.path.join(EXAMPLES_PATH, 'source_mapping.csv')),
+        parse_csv_mapping(os.path.join(EXAMPLES_PATH, 'destination_mapping.csv')),
+    )
+
+@pytest.fixture
+def dataset_path(tmp_path):
+    # The row index is written next to the dataset
+    path = tmp_path / 'dataset.csv'
+    shutil.copyfile(os.path.join(EXAMPLES_PATH, 'dataset.csv'), path)
+    return str(path)
+
+@pytest.fixture
+def build_parser(mappings):
+    def build(pg, **kwargs):
+        (source_mapping, destination_mapping) = mappings
+        return DataParser(source_mapping, destination_mapping, FOLLOW_UP_SUFFIX, None, COHORT_ID, None, None, pg,
+            **kwargs)
+    return build
@@ -0,0 +1,37 @@
+import os
+
+from click.testing import CliRunner
+
+from cdm_parser_cli import cli
+from conftest import EXAMPLES_PATH
+from constants import *
+
+def run_cli(args, dataset_path):
+    return CliRunner().invoke(cli, args, env={
+        DOCKER_ENV: '1',
+        DATASET_PATH: dataset_path,
+        SOURCE_MAPPING_PATH: os.path.join(EXAMPLES_PATH, 'source_mapping.csv'),
+        DESTINATION_MAPPING_PATH: os.path.join(EXAMPLES_PATH, 'destination_mapping.csv'),
+    })
+
+def test_resume_requires_commit_every(dataset_path):
+    """ Without --commit-every the checkpoint would only be stored at the end.
+    """
+    result = run_cli(['parse-data', '--cohort-name', 'test', '--resume'], dataset_path)
+    assert result.exit_code == 2
+    assert '--resume requires --commit-every' in result.output
+
+def test_resume_with_incremental(dataset_path):
+    """ The rows with the same source id are hashed together, including the rows already parsed.
+    """
+    result = run_cli(['parse-data', '--cohort-name', 'test', '--commit-every', '10', '--resume', '--incremental'],
+        dataset_path)
+    assert result.exit_code == 2
+    assert '--resume and --incremental' in result.output
+
+def test_output_dir_requires_cohort_name(dataset_path, tmp_path):
+    """ The links to the source ids are stored with the cohort inserted when loading the files.
+    """
+    result = run_cli(['parse-data', '--cohort-name', '', '--output-dir', str(tmp_path / 'staging')], dataset_path)
+    assert result.exit_code == 2
+    assert '--output-dir requires --cohort-name' in result.output
@@ -0,0 +1,31 @@
+import csv
+
+from conftest import FakeDatabase
+from constants import *
+from parallel_parser import filter_shard_frames, read_source_ids, split_dataset
+from parse_dataset import DataParser
+
+def test_checkpoint_from_shard_frames(build_parser, dataset_path):
+    """ The last row of a chunk filtered for a shard (rows 0, 1, and 3 for the
+        first shard) is a numpy integer, stored as an int.
+    """
+    with open(dataset_path, 'r', newline='') as dataset_file:
+        rows = list(csv.reader(dataset_file))
+    with open(dataset_path, 'w', newline='') as dataset_file:
+        csv.writer(dataset_file).writerows([rows[0], rows[1], rows[2], rows[4], rows[3], rows[5]])
+    pg = FakeDatabase()
+    id_source_variable = build_parser(pg).get_source_variable(SOURCE_ID)
+    source_ids = read_source_ids(dataset_path, id_source_variable, 0, -1, False, ',')
+    shards = split_dataset(source_ids, 3)
+    for shard in shards:
+        parser = build_parser(pg)
+        start = parser.load_checkpoint(dataset_path, shard[START])
+        DataParser.parse_dataset(dataset_path, start, shard[END] - start + 1, False, ',',
+            lambda frames, **kwargs: parser.transform_frames(
+                filter_shard_frames(frames, shard, id_source_variable), **kwargs),
+            vectorized=True, chunk_size=10, commit_every=1)
+    last_rows = {range_start: last_row for (_, _, range_start), (last_row, _) in pg.checkpoints.items()}
+    assert last_rows == {shard[START]: shard[END] for shard in shards}
+    assert all(type(last_row) is int for last_row in last_rows.values())
+    assert pg.transaction_level == 0
+    assert len(pg.persons) == len({source_id for (_, source_id) in source_ids})
@@ -0,0 +1,68 @@
+import csv
+
+import pytest
+
+from conftest import FakeDatabase
+from parse_dataset import DataParser
+
+def parse(build_parser, pg, path, incremental=True, vectorized=False, commit_every=None):
+    """ Parse the dataset as done by parse-data (hashing the rows first when incremental).
+    """
+    parser = build_parser(pg, incremental=incremental)
+    if incremental:
+        DataParser.parse_dataset(path, 0, -1, False, ',', parser.hash_rows, columns=parser.get_required_columns())
+    DataParser.parse_dataset(path, 0, -1, False, ',', parser.transform_frames if vectorized else parser.transform_rows,
+        copy=True, vectorized=vectorized, chunk_size=2, commit_every=commit_every,
+        columns=parser.get_required_columns())
+    return pg
+
+def update_dataset(path, row, column, value):
+    with open(path, 'r', newline='') as dataset_file:
+        rows = list(csv.reader(dataset_file))
+    rows[row + 1][rows[0].index(column)] = value
+    with open(path, 'w', newline='') as dataset_file:
+        csv.writer(dataset_file).writerows(rows)
+
+@pytest.mark.parametrize('vectorized', [False, True])
+@pytest.mark.parametrize('commit_every', [None, 1])
+def test_repeated_source_id(build_parser, dataset_path, vectorized, commit_every):
+    """ The source id 001 is included in two rows, with a different visit in each one.
+    """
+    expected = parse(build_parser, FakeDatabase(), dataset_path, incremental=False).get_content()
+    pg = parse(build_parser, FakeDatabase(), dataset_path, vectorized=vectorized, commit_every=commit_every)
+    assert pg.get_content() == expected
+    assert len([visit for visit in pg.visits.values() if pg.source_ids[visit['person_id']] == '001']) == 3
+
+    # Without changes, nothing is transformed again
+    records = {table: dict(table_records) for table, table_records in pg.records.items()}
+    parse(build_parser, pg, dataset_path, vectorized=vectorized, commit_every=commit_every)
+    assert pg.records == records
+
+@pytest.mark.parametrize('commit_every', [None, 1])
+def test_repeated_source_id_changed(build_parser, dataset_path, commit_every):
+    """ Changing one of the rows with the source id 001 transforms both rows again.
+    """
+    pg = parse(build_parser, FakeDatabase(), dataset_path, commit_every=commit_every)
+    previous = pg.get_content()
+    update_dataset(dataset_path, 2, 'cholesterol', '7.2')
+    update_dataset(dataset_path, 0, 'date_FU1', '26/09/2009')
+    expected = parse(build_parser, FakeDatabase(), dataset_path, incremental=False).get_content()
+    assert expected != previous
+    parse(build_parser, pg, dataset_path, commit_every=commit_every)
+    assert pg.get_content() == expected
+
+def test_repeated_source_id_interrupted(build_parser, dataset_path):
+    """ After an interruption between the rows with the source id 001, they are
+        transformed again in the next run.
+    """
+    pg = parse(build_parser, FakeDatabase(), dataset_path, commit_every=1)
+    update_dataset(dataset_path, 0, 'date', '24/01/2004')
+    update_dataset(dataset_path, 2, 'date', '22/7/2004')
+    expected = parse(build_parser, FakeDatabase(), dataset_path, incremental=False).get_content()
+    parser = build_parser(pg, incremental=True)
+    DataParser.parse_dataset(dataset_path, 0, -1, False, ',', parser.hash_rows, columns=parser.get_required_columns())
+    # Only the first row is committed
+    DataParser.parse_dataset(dataset_path, 0, 1, False, ',', parser.transform_rows, copy=True, commit_every=1,
+        columns=parser.get_required_columns())
+    parse(build_parser, pg, dataset_path, commit_every=1)
+    assert pg.get_content() == expected
@@ -0,0 +1,78 @@
+import csv
+
+import pandas as pd
+import pytest
+
+from conftest import FOLLOW_UP_SUFFIX, FakeDatabase
+from constants import *
+from exceptions import ParsingError
+from parse_dataset import DataParser
+
+def test_mapping_warnings(build_parser, capsys):
+    """ The variables skipped are only reported when requested (once in parse-data).
+    """
+    parser = build_parser(FakeDatabase())
+    assert 'Skipped variable' not in capsys.readouterr().out
+    parser.print_mapping_warnings()
+    assert 'Skipped variable bmi since its not mapped' in capsys.readouterr().out
+
+def test_numeric_threshold_parity(build_parser, mappings, dataset_path):
+    """ A numeric variable with a threshold read as numbers (e.g. from SPSS) is
+        parsed the same way by the rows and the vectorized transform.
+    """
+    (source_mapping, destination_mapping) = mappings
+    source_mapping['dbp'][THRESHOLD] = '80'
+    destination_mapping['dbp'][TYPE] = TYPE_NUMERIC
+    frame = pd.read_csv(dataset_path, dtype=str, keep_default_na=False)
+    frame['d_b_p'] = pd.to_numeric(frame['d_b_p'])
+    contents = []
+    for vectorized in (False, True):
+        parser = build_parser(FakeDatabase())
+        if vectorized:
+            parser.transform_frames([frame], 0, -1, copy=True)
+        else:
+            parser.transform_rows(frame.iterrows(), 0, -1, copy=True)
+        contents.append(parser.pg.get_content())
+    assert contents[0] == contents[1]
+    assert any(record[0] == 'MEASUREMENT' and '1.0' in record for record in contents[0][0])
+
+def test_persons_flushed_with_links(build_parser, dataset_path):
+    """ The links between the source id and the person id are inserted with the
+        persons (e.g. when the visits are flushed for each row).
+    """
+    pg = FakeDatabase()
+    parser = build_parser(pg)
+    with open(dataset_path, newline='') as dataset_file:
+        row = next(csv.DictReader(dataset_file))
+    person_id = parser.get_person(0, row, parser.get_source_variable(SOURCE_ID))
+    parser.flush_visits()
+    assert pg.persons.keys() == pg.source_ids.keys() == {person_id}
+
+def test_visits_reused_without_cohort(mappings, dataset_path):
+    """ Without a cohort, the visits created in a previous run are reused.
+    """
+    pg = FakeDatabase()
+    visits = []
+    for _ in range(2):
+        parser = DataParser(*mappings, FOLLOW_UP_SUFFIX, None, None, None, None, pg)
+        DataParser.parse_dataset(dataset_path, 0, -1, False, ',', parser.transform_rows, copy=True)
+        visits.append(dict(pg.visits))
+    assert visits[0] == visits[1]
+
+@pytest.mark.parametrize('vectorized', [False, True])
+def test_unsupported_file_type(tmp_path, vectorized):
+    """ Only csv, SPSS, and SAS files can be read.
+    """
+    with pytest.raises(ParsingError, match='Unsupported file type'):
+        DataParser.parse_dataset(str(tmp_path / 'dataset.txt'), 0, -1, False, ',', None, vectorized=vectorized)
+
+def test_prepared_records_committed_per_row(build_parser, dataset_path):
+    """ Without --copy or --bulk, the records for a row are committed together
+        instead of once for each domain.
+    """
+    pg = FakeDatabase()
+    parser = build_parser(pg)
+    DataParser.parse_dataset(dataset_path, 0, -1, False, ',', parser.transform_rows,
+        columns=parser.get_required_columns())
+    assert all(len(records) > 0 for records in pg.records.values())
+    assert len(pg.autocommits) < sum(len(tables) for tables in pg.autocommits)
@@ -0,0 +1,31 @@
+import collections
+
+from conftest import COHORT_ID, FOLLOW_UP_SUFFIX, FakeDatabase
+from parse_dataset import DataParser
+from staging import StagingWriter, load_staging
+
+def test_load_staging(mappings, dataset_path, tmp_path):
+    """ The files written are loaded after the records already in the database,
+        moving the ids to the blocks reserved and setting the cohort.
+    """
+    pg = FakeDatabase()
+    parser = DataParser(*mappings, FOLLOW_UP_SUFFIX, None, COHORT_ID, None, None, pg)
+    DataParser.parse_dataset(dataset_path, 0, -1, False, ',', parser.transform_rows, copy=True)
+    expected = pg.get_content()
+
+    output_dir = str(tmp_path / 'staging')
+    with StagingWriter(output_dir, 'staging') as staging:
+        parser = DataParser(*mappings, FOLLOW_UP_SUFFIX, None, None, None, None, None, staging=staging)
+        DataParser.parse_dataset(dataset_path, 0, -1, False, ',', parser.transform_rows, copy=True)
+        staging.write_manifest(parser.allocator.get_last_ids())
+    load_staging(pg, output_dir)
+
+    # The records loaded don't replace the previous ones
+    assert pg.get_content() == tuple(content + content for content in expected)
+    cohort_id = pg.cohorts['staging']
+    assert cohort_id != COHORT_ID
+    persons = len(expected[2])
+    assert collections.Counter(map(str, pg.id_cohorts.values())) == {str(COHORT_ID): persons, str(cohort_id): persons}
+    assert collections.Counter(str(person['cohort_id']) for person in pg.persons.values()) == \
+        {str(COHORT_ID): persons, str(cohort_id): persons}
+    assert {str(visit['cohort_id']) for visit in pg.visits.values()} == {str(COHORT_ID), str(cohort_id)}
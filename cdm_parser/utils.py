@@ -1,11 +1,28 @@
+import hashlib
 import os
+import queue
+import re
 import subprocess
+import threading
 from configparser import ConfigParser
 from datetime import datetime
+from functools import lru_cache
 
 from dateutil.relativedelta import relativedelta
 import pandas as pd
 
+from constants import DATE_CACHE_SIZE, FINGERPRINT_SIZE, READ_AHEAD_BATCH_SIZE
+
+# Regular expressions used by datetime.strptime for the numeric directives
+DATE_DIRECTIVES = {
+    'd': r'(?P<d>3[0-1]|[1-2]\d|0[1-9]|[1-9]| [1-9])',
+    'm': r'(?P<m>1[0-2]|0[1-9]|[1-9])',
+    'Y': r'(?P<Y>\d\d\d\d)',
+    'H': r'(?P<H>2[0-3]|[0-1]\d|\d)',
+    'M': r'(?P<M>[0-5]\d|\d)',
+    'S': r'(?P<S>6[0-1]|[0-5]\d|\d)',
+}
+
 def import_config(path, section):
     """ Import the configurations from a file and set them as
         environment variables.
@@ -42,17 +59,147 @@ def arrays_to_dict(keys, values):
     """
     return {keys[i]: values[i] for i in range(len(keys))}
 
+def get_dataset_fingerprint(path):
+    """ Identify a dataset by its size and the content at the start and
+        at the end of the file.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as dataset:
+        digest.update(dataset.read(FINGERPRINT_SIZE))
+        if size > FINGERPRINT_SIZE:
+            dataset.seek(max(FINGERPRINT_SIZE, size - FINGERPRINT_SIZE))
+            digest.update(dataset.read())
+    return digest.hexdigest()
+
+def batches(iterator, size=None, count=None):
+    """ Split an iterator in consecutive batches, each one including at least
+        the number of items provided (the last batch may include less). The
+        count function allows to weight each item (e.g. the rows in a DataFrame).
+        Without a size, all items are included in a single batch. The batches
+        are iterators and must be consumed in order.
+    """
+    iterator = iter(iterator)
+    end = object()
+
+    def batch(first):
+        total = count(first) if count else 1
+        yield first
+        while size is None or total < size:
+            item = next(iterator, end)
+            if item is end:
+                return
+            total += count(item) if count else 1
+            yield item
+
+    first = next(iterator, end)
+    while first is not end:
+        yield batch(first)
+        first = next(iterator, end)
+
+def read_ahead(iterator, size, batch_size=READ_AHEAD_BATCH_SIZE):
+    """ Read the items from an iterator in a separate thread, keeping up to size
+        batches of items in a bounded queue. The thread is stopped when the
+        iterator returned is closed.
+    """
+    items = queue.Queue(maxsize=int(size))
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for batch in batches(iterator, batch_size):
+                if not put((list(batch), None)):
+                    return
+            put((end, None))
+        except Exception as error:
+            put((end, error))
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            (batch, error) = items.get()
+            if error is not None:
+                raise error
+            if batch is end:
+                return
+            yield from batch
+    finally:
+        stop.set()
+        thread.join()
+
+@lru_cache(maxsize=None)
+def compile_date_format(input_format):
+    """ Build the regular expression to parse a date with the numeric directives
+        (day, month, year, hour, minute, second), following datetime.strptime.
+        Returns None for the formats with other directives.
+    """
+    pattern = ''
+    position = 0
+    while position < len(input_format):
+        character = input_format[position]
+        if character == '%':
+            directive = input_format[position + 1:position + 2]
+            if directive not in DATE_DIRECTIVES:
+                return None
+            pattern += DATE_DIRECTIVES[directive]
+            position += 2
+        else:
+            if not character.isspace():
+                pattern += re.escape(character)
+            elif not pattern.endswith(r'\s+'):
+                pattern += r'\s+'
+            position += 1
+    try:
+        return re.compile(pattern, re.IGNORECASE)
+    except re.error:
+        return None
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_datetime(date, input_format):
+    """ Parse a date, equivalent to datetime.strptime. The formats with only
+        numeric directives are parsed with a regular expression, relying on
+        strptime for the remaining formats and to report the errors.
+    """
+    expression = compile_date_format(input_format) if isinstance(date, str) else None
+    match = expression.match(date) if expression else None
+    if match and match.end() == len(date):
+        fields = match.groupdict()
+        try:
+            return datetime(
+                int(fields.get('Y', 1900)),
+                int(fields.get('m', 1)),
+                int(fields.get('d', 1)),
+                int(fields.get('H', 0)),
+                int(fields.get('M', 0)),
+                int(fields.get('S', 0)),
+            )
+        except ValueError:
+            pass
+    return datetime.strptime(date, input_format)
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
 def parse_date(date, input_format, output_format):
     """ Parse a date from one format to another.
     """
-    date_parsed = datetime.strptime(date, input_format)
+    date_parsed = parse_datetime(date, input_format)
     return date_parsed.strftime(output_format)
 
 def get_year_of_birth(age, date, input_format):
     """ Retrieve the year of birth from the age at a specific date.
     """
     _, fraction = divmod(age, 1)
-    date_parsed = datetime.strptime(date, input_format)
+    date_parsed = parse_datetime(date, input_format)
     return (date_parsed - relativedelta(years=int(age), days=fraction * 365)).year
 
 def parse_float(value):
@@ -63,6 +210,11 @@ def parse_float(value):
     except ValueError:
         return float(value.replace(",", "."))
 
+def is_flag_set(value):
+    """ Check if a flag from the configurations is set (e.g. not empty or False).
+    """
+    return bool(value) and str(value).strip().lower() not in ['false', '0', 'no', 'none']
+
 def is_value_valid(value):
     """ Check if a value is null, None, or empty.
     """
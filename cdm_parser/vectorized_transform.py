@@ -0,0 +1,253 @@
+import pandas as pd
+
+from cdm_builder import CDM_TABLES
+from constants import *
+from exceptions import ParsingError
+from utils import parse_date, parse_float
+
+class FrameTransformer:
+    """ Transforms a chunk of the dataset (DataFrame) one variable at a time,
+        producing the observations, measurements, and conditions as columnar
+        batches (a DataFrame for each domain).
+        The results follow the row by row transformation (DataParser.transform_row),
+        values are parsed once for each distinct value in the chunk.
+    """
+    def __init__(self, parser):
+        self.parser = parser
+
+    @staticmethod
+    def valid_mask(frame, variable, ignore_values=[]):
+        """ Vectorized version of DataParser.valid_row_value.
+        """
+        # The range and limit validation never reject a value in valid_row_value
+        # (the clause checking for the symbols is always true), the same
+        # behaviour is kept here.
+        if variable not in frame:
+            return pd.Series(False, index=frame.index)
+        values = frame[variable]
+        text = values.map(str)
+        mask = values.notna() & (text.str.strip() != '')
+        if ignore_values:
+            mask &= ~text.isin(ignore_values)
+        return mask
+
+    @staticmethod
+    def map_unique(values, function, *columns):
+        """ Apply a function once for each distinct combination of values. Returns
+            the results and the errors (ParsingError) aligned with the values.
+        """
+        if len(values) == 0:
+            return (pd.Series(dtype=object), pd.Series(dtype=object))
+        keys = pd.DataFrame({f'key_{i}': column for i, column in enumerate((values,) + columns)})
+        codes = keys.groupby(list(keys.columns), sort=False, dropna=False).ngroup()
+        first_rows = ~codes.duplicated()
+        results = {}
+        errors = {}
+        for code, key in zip(codes[first_rows], keys[first_rows].itertuples(index=False, name=None)):
+            try:
+                results[code] = function(*key)
+            except ParsingError as error:
+                errors[code] = error
+        return (codes.map(results), codes.map(errors))
+
+    def select_source_values(self, plan, frame, wave):
+        """ Select the source values for each row: the first valid source variable
+            (considering the alternatives and condition) and the source value stored.
+        """
+        selected = []
+        chosen = []
+        for source_variable in plan.source_variables:
+            valid = self.valid_mask(frame, source_variable, ignore_values=self.parser.missing_values)
+            condition = valid if plan.condition is None or source_variable not in frame \
+                else valid & frame[source_variable].isin(plan.condition)
+            selected.append((source_variable, condition, valid & ~condition))
+        has_condition = pd.Series(False, index=frame.index)
+        for (_, condition, _) in selected:
+            has_condition |= condition
+        for (source_variable, condition, alternative) in selected:
+            chosen.append((source_variable, condition.where(has_condition, alternative)))
+
+        values = pd.Series(None, index=frame.index, dtype=object)
+        variables = pd.Series(None, index=frame.index, dtype=object)
+        source_values = pd.Series(None, index=frame.index, dtype=object)
+        numeric = True
+        for (source_variable, mask) in reversed(chosen):
+            if mask.any():
+                values = values.mask(mask, frame[source_variable])
+                variables = variables.mask(mask, self.parser.reshaper.get_column(wave, source_variable))
+                numeric &= pd.api.types.is_numeric_dtype(frame[source_variable])
+        for (source_variable, mask) in chosen:
+            if mask.any():
+                text = frame[source_variable].map(str)
+                source_values = source_values.mask(
+                    mask, text.where(source_values.isna(), source_values + DEFAULT_SEPARATOR + text))
+        return (values, variables, source_values.str[:50], numeric)
+
+    def parse_values(self, plan, values, variables, numeric, wave):
+        """ Parse the values for a variable. Returns the parsed values, the symbol
+            concept ids, and the errors.
+        """
+        if numeric and plan.variable not in self.parser.value_mapping and plan.type != TYPE_DATE:
+            # Numeric values without a mapping can be parsed without looking at
+            # each distinct value (numbers don't include symbols).
+            parsed = values.astype(float) if plan.type == TYPE_NUMERIC or plan.threshold or plan.conversion \
+                else values
+            if plan.threshold:
+                parsed = parsed > parse_float(plan.threshold)
+            if plan.type == TYPE_NUMERIC:
+                # As in parse_value, the thresholded values are stored as 1.0/0.0
+                parsed = parsed.astype(float)
+            if plan.conversion:
+                parsed = parsed.astype(float) * parse_float(plan.conversion)
+            empty = pd.Series(None, index=values.index, dtype=object)
+            return (parsed.astype(object), empty, empty)
+
+        (prefix, suffix) = wave
+        (results, errors) = self.map_unique(
+            values,
+            lambda value, source_variable: self.parser.get_parsed_value(
+                plan.variable,
+                value,
+                conversion=plan.conversion,
+                threshold=plan.threshold,
+                source_variable=source_variable,
+                format=plan.format,
+                type=plan.type,
+                prefix=prefix,
+                suffix=suffix,
+            ),
+            variables,
+        )
+        parsed = results.map(lambda result: result[1], na_action='ignore')
+        symbols = results.map(lambda result: result[2], na_action='ignore')
+        return (parsed, symbols, errors)
+
+    def parse_dates(self, plan, frame, visits, wave):
+        """ Retrieve the date and visit id for a variable in each row.
+        """
+        dates = pd.Series(DATE_DEFAULT, index=frame.index, dtype=object)
+        # By default, the first visit available in the row
+        visit_ids = pd.Series(None, index=frame.index, dtype=object)
+        for date_variable in reversed(visits.columns):
+            visit_ids = visit_ids.mask(visits[date_variable].notna(), visits[date_variable])
+        errors = pd.Series(None, index=frame.index, dtype=object)
+        if plan.date_variables:
+            resolved = pd.Series(False, index=frame.index)
+            for source_date_variable in plan.date_variables:
+                if source_date_variable in visits:
+                    visit_ids = visit_ids.mask(~resolved & visits[source_date_variable].notna(),
+                        visits[source_date_variable])
+                valid = ~resolved & self.valid_mask(frame, source_date_variable, ignore_values=self.parser.missing_values)
+                if valid.any():
+                    (parsed, parse_errors) = self.map_unique(
+                        frame.loc[valid, source_date_variable].map(str),
+                        lambda date: self.parse_date(
+                            plan, self.parser.reshaper.get_column(wave, source_date_variable), date),
+                    )
+                    dates = dates.mask(valid, parsed)
+                    errors = errors.mask(valid & parse_errors.reindex(frame.index).notna(), parse_errors)
+                    resolved |= valid
+        return (dates, visit_ids, errors)
+
+    @staticmethod
+    def parse_date(plan, source_date_variable, date):
+        """ Parse the date for a variable.
+        """
+        try:
+            return parse_date(date, plan.date_format, DATE_FORMAT)
+        except Exception as error:
+            raise ParsingError(
+                f'Error parsing a malformated date for variable {plan.variable} \
+                    with source variable {source_date_variable}: {str(error)})'
+            )
+
+    def parse_additional_info(self, plan, frame, wave):
+        """ Retrieve the additional information for a variable in each row.
+        """
+        additional_info = pd.Series(plan.additional_info_static, index=frame.index, dtype=object)
+        errors = pd.Series(None, index=frame.index, dtype=object)
+        if plan.additional_info_variable:
+            additional_info_variable = self.parser.reshaper.get_column(wave, plan.additional_info_variable)
+            valid = self.valid_mask(frame, plan.additional_info_variable)
+            if valid.any():
+                (results, parse_errors) = self.map_unique(
+                    frame.loc[valid, plan.additional_info_variable],
+                    lambda value: self.parser.get_parsed_value(
+                        additional_info_variable, value, source_variable=additional_info_variable)[1],
+                )
+                additional_info = additional_info.mask(
+                    valid, results.map(lambda result: f'{additional_info_variable}: {result}', na_action='ignore'))
+                errors = errors.mask(valid & parse_errors.reindex(frame.index).notna(), parse_errors)
+        return (additional_info, errors)
+
+    def transform_plan(self, plan, frame, person_ids, visits, wave):
+        """ Transform a variable for all the rows in the frame.
+        """
+        sequence = CDM_TABLES[plan.domain][SEQUENCE]
+        if plan.aggregate:
+            # Aggregations combine multiple source variables in each row,
+            # relying on the row by row transformation.
+            records = []
+            rows = frame.to_dict('index')
+            for index, row in rows.items():
+                row_visits = visits.loc[index].dropna().to_dict()
+                named_args = self.parser.execute_plan(plan, row, row_visits, wave)
+                if named_args is not None:
+                    records.append(plan.build_record(
+                        self.parser.allocator.next_id(sequence), person_ids[index], plan.field, **named_args))
+            return pd.DataFrame.from_records(records, columns=CDM_TABLES[plan.domain][COLUMNS])
+
+        if plan.source_variables:
+            (values, variables, source_values, numeric) = self.select_source_values(plan, frame, wave)
+        elif plan.static_value:
+            values = pd.Series(plan.static_value, index=frame.index, dtype=object)
+            variables = pd.Series(None, index=frame.index, dtype=object)
+            source_values = pd.Series(str(plan.static_value)[:50], index=frame.index, dtype=object)
+            numeric = False
+        else:
+            return None
+        rows = values.notna()
+        if not rows.any():
+            return None
+        frame = frame.loc[rows]
+        visits = visits.loc[rows]
+        (parsed, symbols, value_errors) = self.parse_values(plan, values[rows], variables[rows], numeric, wave)
+        rows = parsed.map(lambda value: not isinstance(value, str) or value != DEFAULT_SKIP) | value_errors.notna()
+        (dates, visit_ids, date_errors) = self.parse_dates(plan, frame, visits, wave)
+        (additional_info, info_errors) = self.parse_additional_info(plan, frame, wave)
+
+        errors = value_errors.where(value_errors.notna(), date_errors.where(date_errors.notna(), info_errors))
+        errors = errors[rows & errors.notna()]
+        if len(errors) > 0:
+            self.parser.warn_variable(plan.variable, errors.iloc[0])
+            rows &= ~rows.index.isin(errors.index)
+        if not rows.any():
+            return None
+
+        index = rows[rows].index
+        value_as_concept = plan.variable in self.parser.value_mapping and \
+            self.parser.value_mapping[plan.variable][VALUE_AS_CONCEPT_ID]
+        record = plan.build_record(
+            pd.Series(self.parser.allocator.next_ids(sequence, len(index)), index=index, dtype=object),
+            person_ids[index],
+            plan.field,
+            value=None if value_as_concept else parsed[index],
+            value_as_concept=parsed[index] if value_as_concept else None,
+            source_value=source_values[index],
+            date=dates[index],
+            visit_id=visit_ids[index],
+            additional_info=additional_info[index],
+            symbol_cid=symbols[index],
+        )
+        return pd.DataFrame(dict(zip(CDM_TABLES[plan.domain][COLUMNS], record)), index=index)
+
+    def transform_frame(self, frame, person_ids, visits, wave):
+        """ Transform the rows in the frame for a wave. The visits are represented
+            by a frame with a column for each visit date variable.
+        """
+        batches = {}
+        for plan in self.parser.plans:
+            batch = self.transform_plan(plan, frame, person_ids, visits, wave)
+            if batch is not None and len(batch) > 0:
+                batches.setdefault(plan.domain, []).append(batch)
+        return {domain: pd.concat(domain_batches) for domain, domain_batches in batches.items()}
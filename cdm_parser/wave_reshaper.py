@@ -0,0 +1,52 @@
+class WaveReshaper:
+    """ Reshapes the rows from the dataset (wide format, with a column for each
+        variable in each wave) to a record for each wave. The values in each
+        record are keyed by the variable name, without the follow up prefix or
+        suffix, so the transformation doesn't depend on the wave.
+    """
+    def __init__(self, waves, variables):
+        self.waves = waves
+        # Column in the dataset for each wave and variable
+        self.columns = {
+            wave: {variable: wave[0] + variable + wave[1] for variable in variables} for wave in waves
+        }
+        # Variables and columns available in the dataset for each wave
+        self.available_columns = None
+
+    def get_column(self, wave, variable):
+        """ Retrieve the column in the dataset for a variable in a wave.
+        """
+        if variable in self.columns[wave]:
+            return self.columns[wave][variable]
+        return wave[0] + variable + wave[1]
+
+    def get_required_columns(self):
+        """ Retrieve the columns for every variable in every wave.
+        """
+        return {column for wave_columns in self.columns.values() for column in wave_columns.values()}
+
+    def set_available_columns(self, columns):
+        """ Keep the columns available in the dataset for each wave.
+        """
+        self.available_columns = {
+            wave: [(variable, column) for variable, column in wave_columns.items() if column in columns]
+                for wave, wave_columns in self.columns.items()
+        }
+
+    def reshape_row(self, row):
+        """ Reshape a row to a record for each wave (following the order of the
+            waves). The waves without any column in the dataset are not included.
+        """
+        if self.available_columns is None:
+            self.set_available_columns(row.keys())
+        return [(wave, {variable: row[column] for (variable, column) in self.available_columns[wave]})
+            for wave in self.waves if self.available_columns[wave]]
+
+    def reshape_frame(self, frame):
+        """ Reshape a chunk of the dataset (DataFrame) to a chunk for each wave,
+            with a column for each variable.
+        """
+        self.set_available_columns(frame.columns)
+        return [(wave, frame[[column for (_, column) in self.available_columns[wave]]].set_axis(
+            [variable for (variable, _) in self.available_columns[wave]], axis=1))
+            for wave in self.waves if self.available_columns[wave]]